@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Checks the cost of importing check_javamelody_health.py, fails (exit code 1) if
+- modules meant to be imported only where they are used (e.g. http.server for --serve) are imported along with the plugin
+- the plugin imports more than --max-modules modules on top of those imported by nagiosplugin
+- the import of the plugin takes more than --max-ratio times as long as the import of nagiosplugin alone
+  (median of --repeat imports each, measured with -X importtime). Both are measured alternately on the same
+  machine, so the ratio holds on slow or busy machines, where an absolute budget (--budget-ms) would not."""
+
+import argparse
+import py_compile
+import statistics
+import subprocess
+import sys
+from os.path import dirname, abspath, join
+
+__author__ = "Armon Dressler"
+__license__ = "GPLv3"
+__email__ = "armon.dressler@gmail.com"
+
+PLUGIN_DIR = dirname(dirname(abspath(__file__)))
+PLUGIN = "check_javamelody_health"
+#the one dependency the plugin can't do without, its import cost is the reference
+REFERENCE = "nagiosplugin"
+#imported by the code paths needing them only
+DEFERRED_MODULES = ["http.server", "http.client", "socketserver", "socket", "sqlite3", "ssl", "hashlib",
+                    "queue", "urllib.parse", "urllib.request", "email", "mmap", "base64"]
+
+
+def get_import_time(module):
+    """returns the cumulative import time of module in microseconds as reported by -X importtime"""
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                             cwd=PLUGIN_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    for line in process.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1])
+    raise ValueError("No import time reported for {}.".format(module))
+
+
+def get_imported_modules(module):
+    process = subprocess.run([sys.executable, "-c", "import sys, {}; print(' '.join(sys.modules))".format(module)],
+                             cwd=PLUGIN_DIR, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return set(process.stdout.split())
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-ratio', action='store', type=float, default=1.6,
+                        help='maximum median import time of the plugin relative to the one of nagiosplugin')
+    parser.add_argument('--max-modules', action='store', type=int, default=20,
+                        help='maximum amount of modules imported by the plugin on top of those of nagiosplugin')
+    parser.add_argument('--budget-ms', action='store', type=float, default=None,
+                        help='maximum median import time of the plugin in milliseconds, not checked by default')
+    parser.add_argument('--repeat', action='store', type=int, default=9,
+                        help='imports to take the median of')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    #executions on a satellite use the cached bytecode, even if PYTHONDONTWRITEBYTECODE is set here
+    py_compile.compile(join(PLUGIN_DIR, PLUGIN + ".py"))
+    plugin_times, reference_times = [], []
+    for _ in range(args.repeat):
+        plugin_times.append(get_import_time(PLUGIN))
+        reference_times.append(get_import_time(REFERENCE))
+    import_time_ms = statistics.median(plugin_times) / 1000
+    ratio = statistics.median(plugin_time / reference_time
+                              for plugin_time, reference_time in zip(plugin_times, reference_times))
+    plugin_modules = get_imported_modules(PLUGIN)
+    added_modules = plugin_modules - get_imported_modules(REFERENCE) - {PLUGIN}
+    eagerly_imported = [module for module in DEFERRED_MODULES if module in plugin_modules]
+    print("import of {}: {:.1f}ms, {:.2f} times the import of {} (max {:.2f}), {} modules added (max {})".format(
+        PLUGIN, import_time_ms, ratio, REFERENCE, args.max_ratio, len(added_modules), args.max_modules))
+    failed = False
+    if ratio > args.max_ratio:
+        print("Import takes too long relative to {}.".format(REFERENCE), file=sys.stderr)
+        failed = True
+    if args.budget_ms is not None and import_time_ms > args.budget_ms:
+        print("Startup budget of {:.1f}ms exceeded.".format(args.budget_ms), file=sys.stderr)
+        failed = True
+    if len(added_modules) > args.max_modules:
+        print("Modules added: {}".format(", ".join(sorted(added_modules))), file=sys.stderr)
+        failed = True
+    if eagerly_imported:
+        print("Imported along with the plugin: {}".format(", ".join(eagerly_imported)), file=sys.stderr)
+        failed = True
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Synthetic stand-in for the external API of javamelody (https://github.com/javamelody/javamelody/wiki/ExternalAPI),
+serves ?format=json with or without part=jvm, heaphisto or threads for check_javamelody_health.py to be benchmarked against.
+Counters grow with every request served, so *_timed metrics report something, the first classes
+of the heap histogram grow as well."""
+
+import argparse
+import gzip
+import json
+import random
+import sys
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from time import sleep
+from threading import Lock
+
+__author__ = "Armon Dressler"
+__license__ = "GPLv3"
+__email__ = "armon.dressler@gmail.com"
+
+
+class JavamelodyStub(object):
+    """builds responses resembling those of javamelody, the amount of requests recorded
+    sets the size of full counter dumps"""
+
+    def __init__(self, endpoint_types, requests_per_type, classes=5000, threads=200, seed=0):
+        self.endpoint_types = endpoint_types
+        self.requests_per_type = requests_per_type
+        self.classes = classes
+        self.threads = threads
+        self.served = 0
+        self.lock = Lock()
+        generator = random.Random(seed)
+        #per endpoint type: [(request name, hits, mean duration, error ratio, mean response size)]
+        self.requests = {}
+        for endpoint_type in endpoint_types:
+            self.requests[endpoint_type] = [(self._get_request_name(endpoint_type, index),
+                                             generator.randint(1, 10000),
+                                             generator.randint(1, 2000),
+                                             generator.choice([0, 0, 0, 0.01, 0.1]),
+                                             generator.randint(0, 100000))
+                                            for index in range(requests_per_type)]
+
+    def _get_request_name(self, endpoint_type, index):
+        if endpoint_type == "http":
+            return "/app/resource{}/list GET".format(index)
+        if endpoint_type == "sql":
+            return "SELECT id, name FROM table{} WHERE id = ?".format(index)
+        return "ch.example.Service{}.call".format(index)
+
+    def get_response(self, part=None):
+        with self.lock:
+            self.served += 1
+            served = self.served
+        if part == "jvm":
+            return self._get_jvm(served)
+        if part == "heaphisto":
+            return self._get_heap_histogram(served)
+        if part == "threads":
+            return self._get_threads()
+        if part is None:
+            return {"list": [self._get_counter(endpoint_type, served) for endpoint_type in self.endpoint_types]}
+        return None
+
+    def _get_counter(self, endpoint_type, served):
+        requests = []
+        for name, hits, duration, error_ratio, response_size in self.requests[endpoint_type]:
+            hits += served
+            requests.append([name, {
+                "name": name,
+                "hits": hits,
+                "durationsSum": hits * duration,
+                "durationsSquareSum": hits * duration ** 2,
+                "maximum": duration * 3,
+                "cpuTimeSum": hits * duration // 2,
+                "systemErrors": int(hits * error_ratio),
+                "responseSizesSum": hits * response_size,
+                "childHits": 0,
+                "childDurationsSum": 0,
+                "stackTrace": None}])
+        return {"application": "stub",
+                "name": endpoint_type,
+                "storageName": endpoint_type,
+                "startDate": "2020-01-01T00:00:00.000+0000",
+                "requests": requests,
+                "rumData": {}}
+
+    def _get_heap_histogram(self, served):
+        classes = []
+        for index in range(self.classes):
+            instances = 1000000 // (index + 1) + (served * 100 if index < 3 else 0)
+            classes.append({"name": "ch.example.Entity{}".format(index) if index else "[B",
+                            "instances": instances,
+                            "bytes": instances * 24,
+                            "source": "app.jar"})
+        return {"list": [{
+            "time": "2020-01-01T00:00:00.000+0000",
+            "classes": classes,
+            "permGenClasses": [],
+            "totalHeapBytes": sum(heap_class["bytes"] for heap_class in classes),
+            "totalHeapInstances": sum(heap_class["instances"] for heap_class in classes)}]}
+
+    def _get_threads(self):
+        threads = []
+        for index in range(self.threads):
+            state = ["RUNNABLE", "WAITING", "TIMED_WAITING", "BLOCKED"][index % 4] if index % 10 else "WAITING"
+            threads.append({"name": "http-nio-8080-exec-{}".format(index),
+                            "daemon": True,
+                            "priority": 5,
+                            "state": state,
+                            "deadlocked": state == "BLOCKED" and index < 8,
+                            "cpuTimeMillis": index * 10,
+                            "userTimeMillis": index * 8,
+                            "globalThreadId": index,
+                            "stackTrace": ["ch.example.Service{}.call(Service.java:{})".format(index, line)
+                                           for line in range(30)]})
+        return {"list": [threads]}
+
+    def _get_jvm(self, served):
+        return {"list": [{
+            "pid": "4242@stub",
+            "host": "stub",
+            "memoryInformations": {
+                "usedMemory": 400 * 1024 ** 2 + served % 100 * 1024 ** 2,
+                "maxMemory": 2048 * 1024 ** 2,
+                "usedNonHeapMemory": 180 * 1024 ** 2,
+                "loadedClassesCount": 12000,
+                "garbageCollectionTimeMillis": 1000 + served * 15},
+            "tomcatInformationsList": [{
+                "name": "http-nio-8080",
+                "currentThreadCount": 50,
+                "maxThreads": 200,
+                "currentThreadsBusy": 5,
+                "requestCount": 100000 + served * 20,
+                "errorCount": 10 + served // 10}],
+            "unixOpenFileDescriptorCount": 300,
+            "unixMaxFileDescriptorCount": 65536}]}
+
+
+class JavamelodyStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        #the plugin closes connections early once it found what it was looking for
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def get_request_handler(stub, delay, compress):
+
+    class JavamelodyStubRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            query = parse_qs(urlsplit(self.path).query)
+            response = stub.get_response(query.get("part", [None])[0])
+            if response is None or query.get("format", [None])[0] != "json":
+                self.send_error(404)
+                return
+            body = json.dumps(response).encode('utf-8')
+            compressed = compress and "gzip" in self.headers.get("Accept-Encoding", "")
+            if compressed:
+                body = gzip.compress(body, compresslevel=1)
+            sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if compressed:
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return JavamelodyStubRequestHandler
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--address', action='store', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', action='store', type=int, default=8080,
+                        help='port to listen on, responses are served for any path')
+    parser.add_argument('--endpoint-types', action='store', nargs='+', default=['http', 'sql', 'spring', 'ejb'],
+                        help='endpoint types (counters) to serve in full counter dumps')
+    parser.add_argument('--requests-per-type', action='store', type=int, default=1000,
+                        help='requests recorded per endpoint type, sets the size of full counter dumps')
+    parser.add_argument('--classes', action='store', type=int, default=5000,
+                        help='classes in the heap histogram (part heaphisto)')
+    parser.add_argument('--threads', action='store', type=int, default=200,
+                        help='threads in the thread dump (part threads)')
+    parser.add_argument('--delay', action='store', type=float, default=0,
+                        help='seconds to wait before responding, to emulate a busy jvm')
+    parser.add_argument('--gzip', action='store_true', default=False,
+                        help='compress responses if asked to (as javamelody behind a compressing proxy would)')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+                        help='seed for the requests recorded, same seed results in the same responses')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    stub = JavamelodyStub(args.endpoint_types, args.requests_per_type, classes=args.classes, threads=args.threads,
+                          seed=args.seed)
+    server = JavamelodyStubServer((args.address, args.port), get_request_handler(stub, args.delay, args.gzip))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
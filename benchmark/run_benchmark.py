@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Runs check_javamelody_health.py against javamelody_stub.py (or --url) for every metric and --scan,
+reports end-to-end latency, cpu time and peak memory (maxrss) per case. Save the output of --json
+before and after a change to compare both."""
+
+import argparse
+import json
+import os
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+from os.path import join, dirname, abspath
+from time import perf_counter, sleep, time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from check_javamelody_health import CheckJavamelodyHealth
+
+__author__ = "Armon Dressler"
+__license__ = "GPLv3"
+__email__ = "armon.dressler@gmail.com"
+
+PLUGIN = join(dirname(dirname(abspath(__file__))), "check_javamelody_health.py")
+STUB = join(dirname(abspath(__file__)), "javamelody_stub.py")
+
+
+def get_cases(metrics=None):
+    """returns (case name, plugin arguments), per-path metrics ask for a request the stub records"""
+    cases = []
+    for metric in (CheckJavamelodyHealth.jvm_metrics + CheckJavamelodyHealth.top_metrics +
+                   CheckJavamelodyHealth.heaphisto_metrics + CheckJavamelodyHealth.thread_metrics):
+        cases.append((metric, ["--metric", metric, "--class-name", "[B"]))
+    for metric in CheckJavamelodyHealth.path_metrics:
+        cases.append((metric, ["--metric", metric, "-p", "/app/resource0/list", "-m", "GET"]))
+    cases.append(("scan", ["--scan"]))
+    return [case for case in cases if not metrics or case[0] in metrics]
+
+
+def run_plugin(arguments):
+    """returns wall time, cpu time and maxrss of a single execution along with its exit code"""
+    start = perf_counter()
+    process = subprocess.Popen([sys.executable, PLUGIN] + arguments,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {"wall": wall_time,
+            "cpu": rusage.ru_utime + rusage.ru_stime,
+            "maxrss": rusage.ru_maxrss * 1024,
+            "returncode": process.returncode}
+
+
+def run_case(arguments, url, repeat, plugin_args):
+    """every execution gets its own tmpdir, so neither cache nor state carry over unless asked for"""
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            runs.append(run_plugin(["--url", url, "--tmpdir", tmpdir] + arguments + plugin_args))
+    return {"wall_median": statistics.median(run["wall"] for run in runs),
+            "wall_max": max(run["wall"] for run in runs),
+            "cpu_median": statistics.median(run["cpu"] for run in runs),
+            "maxrss_max": max(run["maxrss"] for run in runs),
+            "returncodes": sorted(set(run["returncode"] for run in runs))}
+
+
+def start_stub(args):
+    with socket.socket() as probe_socket:
+        probe_socket.bind(("127.0.0.1", 0))
+        port = probe_socket.getsockname()[1]
+    command = [sys.executable, STUB, "--port", str(port), "--requests-per-type", str(args.requests_per_type),
+               "--classes", str(args.classes), "--delay", str(args.delay), "--endpoint-types"] + args.endpoint_types
+    if args.gzip:
+        command.append("--gzip")
+    stub = subprocess.Popen(command)
+    deadline = time() + 10
+    while time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            sleep(0.1)
+    else:
+        stub.kill()
+        raise RuntimeError("javamelody_stub.py failed to start")
+    return stub, "http://127.0.0.1:{}/monitoring".format(port)
+
+
+def print_results(results):
+    print("{:<40} {:>10} {:>10} {:>10} {:>12} {:>8}".format(
+        "case", "wall(s)", "max(s)", "cpu(s)", "maxrss(MB)", "rc"))
+    for case, result in results.items():
+        print("{:<40} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.1f} {:>8}".format(
+            case, result["wall_median"], result["wall_max"], result["cpu_median"],
+            result["maxrss_max"] / 1024 ** 2, ",".join(str(code) for code in result["returncodes"])))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', action='store', default=None,
+                        help='benchmark against this javamelody instead of starting javamelody_stub.py')
+    parser.add_argument('--endpoint-types', action='store', nargs='+', default=['http', 'sql', 'spring', 'ejb'],
+                        help='endpoint types served by the stub')
+    parser.add_argument('--requests-per-type', action='store', type=int, default=1000,
+                        help='requests recorded per endpoint type by the stub')
+    parser.add_argument('--classes', action='store', type=int, default=5000,
+                        help='classes in the heap histogram served by the stub')
+    parser.add_argument('--delay', action='store', type=float, default=0,
+                        help='seconds the stub waits before responding')
+    parser.add_argument('--gzip', action='store_true', default=False,
+                        help='have the stub compress its responses')
+    parser.add_argument('--repeat', action='store', type=int, default=5,
+                        help='executions per case, latency and cpu are reported as median')
+    parser.add_argument('--metric', action='extend', nargs='+', default=None,
+                        help='only run these cases (metric names or "scan")')
+    parser.add_argument('--plugin-args', action='store', default="",
+                        help='further arguments for every execution, e.g. --plugin-args="--cache-max-age 30"')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='print results as json for later comparison')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    stub, url = (None, args.url) if args.url else start_stub(args)
+    try:
+        results = {}
+        for case, arguments in get_cases(args.metric):
+            results[case] = run_case(arguments, url, args.repeat, shlex.split(args.plugin_args))
+    finally:
+        if stub:
+            stub.terminate()
+            stub.wait()
+    if args.json:
+        print(json.dumps({"parameters": vars(args), "results": results}, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,28 @@
 import argparse
 import operator
 import json
-from urllib.request import urlopen
+import re
+import io
+import codecs
+import fcntl
+import signal
+import threading
+import heapq
+import struct
+import zlib
+import logging
+from array import array
+from functools import partial
+from contextlib import contextmanager,nullcontext
+from resource import getrusage,RUSAGE_SELF
 import urllib.error
-from sys import stderr
+from sys import stderr,stdout,byteorder
 from collections import OrderedDict
-from os.path import join,exists,isdir
-from os import makedirs
-from time import time
+from os.path import join,exists,isdir,dirname,getmtime
+from os import makedirs,listdir,remove,replace,getpid,chmod,dup2,devnull,environ
+from time import time,sleep,perf_counter,process_time
+#socket, sqlite3, http.client, http.server and the like are imported where they are used,
+#so executions only pay for what the metrics asked for need (see benchmark/check_startup.py)
 
 try:
     import nagiosplugin as nag
@@ -25,7 +40,566 @@ __version__ = "0.5"
 __email__ = "armon.dressler@gmail.com"
 
 
+class JavamelodyConnectionPool(object):
+    """Keeps connections to javamelody hosts open, so subsequent grabs of other parts or other targets
+    on the same host skip connection setup. Responses are requested gzip compressed, see JavamelodyResponseReader.
+    Proxies are used as by urlopen (http_proxy, https_proxy and no_proxy), https is tunneled through them."""
+    max_redirects = 5
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        #(scheme, netloc): [idle connections]
+        self.idle_connections = {}
+        self.lock = threading.Lock()
+        self.proxies = None
+
+    def _get_proxy(self, scheme, netloc):
+        """returns the url of the proxy for netloc, None if it's to be reached directly"""
+        if self.proxies is None:
+            #urllib.request is costly to import, so it's left alone unless a proxy is configured
+            if any(key.lower() in ("http_proxy", "https_proxy") for key in environ):
+                import urllib.request
+                self.proxies = urllib.request.getproxies()
+            else:
+                self.proxies = {}
+        proxy = self.proxies.get(scheme)
+        if not proxy:
+            return None
+        import urllib.request
+        if urllib.request.proxy_bypass(netloc):
+            return None
+        return proxy if "://" in proxy else "http://" + proxy
+
+    def _get_proxy_headers(self, proxy):
+        """returns the Proxy-Authorization header for credentials given in the url of proxy"""
+        from urllib.parse import urlsplit,unquote
+        split_proxy = urlsplit(proxy)
+        if split_proxy.username is None:
+            return {}
+        from base64 import b64encode
+        credentials = "{}:{}".format(unquote(split_proxy.username), unquote(split_proxy.password or ""))
+        return {"Proxy-Authorization": "Basic " + b64encode(credentials.encode('utf-8')).decode('ascii')}
+
+    def _get_connection(self, scheme, netloc, timeout, proxy=None):
+        """returns an idle connection to netloc (through proxy) and whether it was kept alive from a previous grab"""
+        with self.lock:
+            idle_connections = self.idle_connections.get((scheme, netloc))
+            connection = idle_connections.pop() if idle_connections else None
+        if connection is not None:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+        if scheme not in ("http", "https"):
+            raise urllib.error.URLError("unknown url type: {}".format(scheme))
+        import http.client
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        if not proxy:
+            return connection_class(netloc, timeout=timeout), False
+        from urllib.parse import urlsplit
+        connection = connection_class(urlsplit(proxy).netloc.rpartition("@")[2], timeout=timeout)
+        if scheme == "https":
+            connection.set_tunnel(netloc, headers=self._get_proxy_headers(proxy))
+        return connection, False
+
+    def _release_connection(self, scheme, netloc, connection):
+        with self.lock:
+            self.idle_connections.setdefault((scheme, netloc), []).append(connection)
+
+    def _request(self, scheme, netloc, target, timeout):
+        import http.client
+        proxy = self._get_proxy(scheme, netloc)
+        headers = {"Accept-Encoding": "gzip"}
+        #plain http is requested from the proxy by the absolute url, https is tunneled
+        if proxy and scheme == "http":
+            target = "http://" + netloc + target
+            headers.update(self._get_proxy_headers(proxy))
+        #a kept-alive connection might have been closed by the server in the meantime, retry once
+        while True:
+            connection, kept_alive = self._get_connection(scheme, netloc, timeout, proxy)
+            try:
+                connection.request("GET", target, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.HTTPException, ConnectionError) as e:
+                connection.close()
+                if not kept_alive:
+                    raise urllib.error.URLError(e)
+            except OSError as e:
+                connection.close()
+                raise urllib.error.URLError(e)
+
+    def open(self, url, timeout=None, deadline_time=None):
+        """Returns a file-like JavamelodyPooledResponse for url, raises urllib.error exceptions just like urlopen would.
+        The connection is handed back to the pool once the response has been read completely.
+        Reading the response fails once deadline_time (unixtime) has passed, see JavamelodyPooledResponse."""
+        from urllib.parse import urlsplit,urljoin
+        timeout = self.timeout if timeout is None else timeout
+        for redirect in range(self.max_redirects + 1):
+            split_url = urlsplit(url)
+            target = split_url.path + ("?" + split_url.query if split_url.query else "")
+            connection, response = self._request(split_url.scheme, split_url.netloc, target, timeout)
+            pooled_response = JavamelodyPooledResponse(response, partial(
+                self._release_connection, split_url.scheme, split_url.netloc, connection), connection, deadline_time)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                pooled_response.read()
+                pooled_response.close()
+                url = urljoin(url, response.getheader("Location"))
+                continue
+            if response.status >= 400:
+                pooled_response.read()
+                pooled_response.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return pooled_response
+        raise urllib.error.URLError("too many redirects for {}".format(url))
+
+    def get(self, url, timeout=None):
+        """returns the decoded body of url, see open"""
+        response = JavamelodyResponseReader(self.open(url, timeout))
+        try:
+            return "".join(iter(partial(response.read, JsonStream.chunk_size), ""))
+        finally:
+            response.close()
+
+
+class JavamelodyPooledResponse(object):
+    """File-like wrapper around a http.client response, releases its connection to the pool once read completely.
+    The socket timeout applies to every recv on its own, so with deadline_time set every read takes a single recv
+    with the timeout cut down to the time left. A response trickling in fails at deadline_time that way."""
+
+    def __init__(self, response, release, connection, deadline_time=None):
+        self.response = response
+        self.headers = response.headers
+        self.release = release
+        self.connection = connection
+        self.deadline_time = deadline_time
+
+    def read(self, size=-1):
+        import http.client
+        if self.deadline_time is not None and size < 0:
+            return b"".join(iter(partial(self.read, JsonStream.chunk_size), b""))
+        try:
+            if self.deadline_time is None:
+                chunk = self.response.read(size if size >= 0 else None)
+            else:
+                self._set_remaining_timeout()
+                chunk = self.response.read1(size)
+            #reading in chunks, http.client doesn't complain about a connection closed before Content-Length was reached
+            if not chunk and size and self.response.length:
+                raise http.client.IncompleteRead(b"", self.response.length)
+            return chunk
+        except (http.client.HTTPException, OSError) as e:
+            self.connection.close()
+            self.release = None
+            raise urllib.error.URLError(e)
+
+    def _set_remaining_timeout(self):
+        remaining_time = self.deadline_time - time()
+        if remaining_time <= 0:
+            raise TimeoutError("time budget exhausted")
+        if self.connection.sock is not None:
+            self.connection.sock.settimeout(min(self.connection.timeout, remaining_time))
+
+    def close(self):
+        if self.release is None:
+            return
+        #a partially read response leaves the connection unusable
+        if self.response.isclosed():
+            self.release()
+        else:
+            self.response.close()
+            self.connection.close()
+        self.release = None
+
+
+class JavamelodyResponseReader(object):
+    """file-like wrapper around a response from javamelody, decompresses gzip and decodes utf-8 incrementally
+    and drops NUL characters javamelody might include in its json chunk by chunk,
+    so the payload isn't copied once more as a whole.
+    record_result is called with False if receiving the response fails, with True once it's received completely
+    or closed before (e.g. parsing stopped early), so the circuit breaker only counts complete transfers."""
+
+    def __init__(self, response, instrumentation=None, record_result=None):
+        self.response = response
+        self.instrumentation = instrumentation
+        self.record_result = record_result
+        self.transfer_seconds = 0
+        self.transferred_bytes = 0
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        if response.headers.get("Content-Encoding", "").lower() == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = None
+
+    def read(self, size=-1):
+        start = perf_counter()
+        try:
+            text = self._read(size)
+        except (urllib.error.URLError, zlib.error):
+            self._record_result(False)
+            raise
+        finally:
+            self.transfer_seconds += perf_counter() - start
+        if not text:
+            self._record_result(True)
+        return text
+
+    def _record_result(self, success):
+        """passes the result of the transfer on to record_result once"""
+        record_result, self.record_result = self.record_result, None
+        if record_result is not None:
+            record_result(success)
+
+    def _read(self, size):
+        while True:
+            received = self.response.read(size)
+            self.transferred_bytes += len(received)
+            chunk = received
+            if self.decompressor is not None:
+                if not received and not self.decompressor.eof:
+                    raise urllib.error.URLError("incomplete gzip compressed response")
+                chunk = self.decompressor.decompress(received) if received else self.decompressor.flush()
+            text = self.decoder.decode(chunk, final=not received).replace('\0', '')
+            #a chunk might consist of NUL characters, part of a multibyte character or of the gzip header only
+            if text or not received:
+                return text
+
+    def close(self):
+        self.response.close()
+        self._record_result(True)
+        if self.instrumentation is not None:
+            self.instrumentation.add("transfer", self.transfer_seconds, self.transferred_bytes)
+            self.instrumentation = None
+
+
+class JsonStream(object):
+    """Minimal pull parser for json read in chunks from a file-like object.
+    Containers are walked with iter_object and iter_array, values within are either decoded
+    with decode_value or skipped with skip_value. Only the value currently decoded is held in memory,
+    which keeps memory usage bounded for the huge responses javamelody produces for its counters."""
+    chunk_size = 64 * 1024
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, readable):
+        self.readable = readable
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def _fill(self):
+        """appends the next chunk to the unparsed rest of the buffer, returns False at the end of the stream"""
+        if self.eof:
+            return False
+        chunk = self.readable.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """returns the next non-whitespace character without consuming it, "" at the end of the stream"""
+        while True:
+            self.position = self.whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ""
+
+    def _consume(self, expected_characters):
+        character = self.peek()
+        if character not in expected_characters or not character:
+            raise ValueError("Expected one of \"{}\" in json, found \"{}\".".format(expected_characters, character))
+        self.position += 1
+        return character
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                #value continues in the next chunk
+                if not self._fill():
+                    raise
+                continue
+            #numbers at the end of the buffer might continue in the next chunk as well
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.position = end
+            return value
+
+    def skip_value(self):
+        """skips the next value, container elements are decoded one at a time"""
+        if self.peek() == "{":
+            for _ in self.iter_object():
+                self.decode_value()
+        elif self.peek() == "[":
+            for _ in self.iter_array():
+                self.decode_value()
+        else:
+            self.decode_value()
+
+    def iter_object(self):
+        """yields the keys of the next object, the caller has to consume the value of every key"""
+        self._consume("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            key = self.decode_value()
+            self._consume(":")
+            yield key
+            if self._consume(",}") == "}":
+                return
+
+    def close(self):
+        self.readable.close()
+
+    def iter_nested_objects(self, key=None):
+        """Yields the objects found in arrays within the next value at any depth, decoded one at a time.
+        If key is given, only arrays found under key are considered (e.g. "classes" of part heaphisto),
+        containers elsewhere are merely walked to find them."""
+        return self._iter_nested_objects(key, key is None)
+
+    def _iter_nested_objects(self, key, wanted):
+        if self.peek() == "{":
+            for object_key in self.iter_object():
+                yield from self._iter_nested_objects(key, key is None or object_key == key)
+        elif self.peek() == "[":
+            for _ in self.iter_array():
+                if wanted and self.peek() == "{":
+                    yield self.decode_value()
+                else:
+                    yield from self._iter_nested_objects(key, wanted)
+        else:
+            self.decode_value()
+
+    def iter_array(self):
+        """yields once per element of the next array, the caller has to consume every element"""
+        self._consume("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield
+            if self._consume(",]") == "]":
+                return
+
+
+class JavamelodyStateStore(object):
+    """Keeps the last max_samples samples (time, value) per key in a single sqlite database,
+    used to calculate rates from the total counters javamelody reports."""
+
+    def __init__(self, path, max_samples=100):
+        self.path = path
+        self.max_samples = max(1, max_samples)
+        self.connection = None
+
+    def _connect(self):
+        if self.connection:
+            return self.connection
+        import sqlite3
+        try:
+            if not isdir(dirname(self.path)):
+                makedirs(dirname(self.path), exist_ok=True)
+        except PermissionError:
+            print("Failed to create directory {} .".format(dirname(self.path)), file=stderr)
+            raise
+        try:
+            self.connection = sqlite3.connect(self.path, timeout=10)
+            #concurrent executions read while another one writes, no fsync per sample
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS samples "
+                                    "(key TEXT NOT NULL, time REAL NOT NULL, value REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS samples_by_key_and_time ON samples (key, time)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS snapshots "
+                                    "(key TEXT PRIMARY KEY, time REAL NOT NULL, data BLOB NOT NULL)")
+        except sqlite3.Error:
+            print("Failed to open state database at {} .".format(self.path), file=stderr)
+            raise
+        return self.connection
+
+    def get_reference_sample(self, key, since):
+        """returns (time, value) of the oldest sample of key not older than since,
+        the latest sample if there is none, None if there are no samples for key at all"""
+        connection = self._connect()
+        sample = connection.execute("SELECT time, value FROM samples WHERE key = ? AND time >= ? "
+                                    "ORDER BY time LIMIT 1", (key, since)).fetchone()
+        if sample is None:
+            sample = connection.execute("SELECT time, value FROM samples WHERE key = ? "
+                                        "ORDER BY time DESC LIMIT 1", (key,)).fetchone()
+        return sample
+
+    def get_snapshot(self, key):
+        """returns (time, data) of the snapshot stored for key, None if there is none"""
+        return self._connect().execute("SELECT time, data FROM snapshots WHERE key = ?", (key,)).fetchone()
+
+    def set_snapshot(self, key, data, snapshot_time):
+        """snapshots hold data too large for a sample per value (e.g. the size of every class), only the latest is kept"""
+        import sqlite3
+        try:
+            with self._connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO snapshots (key, time, data) VALUES (?, ?, ?)",
+                                   (key, snapshot_time, sqlite3.Binary(data)))
+        except sqlite3.Error:
+            print("Failed to write to state database at {} .".format(self.path), file=stderr)
+            raise
+
+    def add_sample(self, key, value, sample_time):
+        self.add_samples({key: value}, sample_time)
+
+    def add_samples(self, values_by_key, sample_time):
+        """adds a sample per key in a single transaction and drops the ones exceeding max_samples for each key"""
+        import sqlite3
+        try:
+            with self._connect() as connection:
+                for key, value in values_by_key.items():
+                    connection.execute("INSERT INTO samples (key, time, value) VALUES (?, ?, ?)",
+                                       (key, sample_time, value))
+                    connection.execute("DELETE FROM samples WHERE key = ? AND time < "
+                                       "(SELECT time FROM samples WHERE key = ? ORDER BY time DESC LIMIT 1 OFFSET ?)",
+                                       (key, key, self.max_samples - 1))
+        except sqlite3.Error:
+            print("Failed to write to state database at {} .".format(self.path), file=stderr)
+            raise
+
+
+class JavamelodyRequestIndex(object):
+    """Hash table from (endpoint_type, request name) to the stats of the request, persisted in a single file
+    so later executions look up any request without grabbing and parsing the counters of javamelody.
+    Layout (little endian): header (magic, version, slot count, request count, offset of slots, creation time),
+    a record per request (length of key, key, stats) and the slots (hash of key, offset of record; offset 0
+    marks an empty slot) with linear probing. Readers mmap the file, it's replaced atomically when refreshed."""
+    magic = b"JMRI"
+    version = 1
+    header = struct.Struct("<4sIIQQd")
+    record_header = struct.Struct("<I")
+    slot = struct.Struct("<QQ")
+    submetrics = ["hits", "systemErrors", "responseSizesSum", "durationsSum"]
+    stats = struct.Struct("<4q")
+
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self.slot_count = 0
+        self.slots_offset = 0
+        self.created = 0
+
+    def _get_key(self, request_key):
+        """returns the key of request_key as stored along with its unsigned 64 bit hash"""
+        key = "\0".join(request_key)
+        return key.encode('utf-8'), get_name_hash(key) % 2 ** 64
+
+    def open(self):
+        """maps the index file, returns False if there is none or it was written by another version"""
+        import mmap
+        self.close()
+        try:
+            with open(self.path, "rb") as index_file:
+                self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError,ValueError):
+            return False
+        try:
+            magic, version, self.slot_count, _, self.slots_offset, self.created = self.header.unpack_from(self.index)
+        except struct.error:
+            magic = version = None
+        if magic != self.magic or version != self.version:
+            self.close()
+            return False
+        return True
+
+    def is_fresh(self, max_age):
+        return self.open() and time() - self.created <= max_age
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def lookup(self, request_key):
+        """returns the stats of request_key, None if the request isn't part of the index"""
+        key, key_hash = self._get_key(request_key)
+        position = key_hash & (self.slot_count - 1)
+        while True:
+            slot_hash, record_offset = self.slot.unpack_from(self.index, self.slots_offset + position * self.slot.size)
+            if not record_offset:
+                return None
+            if slot_hash == key_hash:
+                key_length, = self.record_header.unpack_from(self.index, record_offset)
+                key_offset = record_offset + self.record_header.size
+                if self.index[key_offset:key_offset + key_length] == key:
+                    return dict(zip(self.submetrics, self.stats.unpack_from(self.index, key_offset + key_length)))
+            position = (position + 1) & (self.slot_count - 1)
+
+    def write(self, recorded_requests):
+        """Writes an index of recorded_requests ((endpoint_type, request name), stats) to a temporary file
+        first, which then replaces the current index. Records are written as they come in, only hash and
+        offset of every record are held in memory until the slots are written."""
+        temporary_path = "{}.{}.tmp".format(self.path, getpid())
+        hashes, offsets = array('Q'), array('Q')
+        try:
+            with open(temporary_path, "wb") as index_file:
+                index_file.write(bytes(self.header.size))
+                for request_key, request_stats in recorded_requests:
+                    key, key_hash = self._get_key(request_key)
+                    hashes.append(key_hash)
+                    offsets.append(index_file.tell())
+                    index_file.write(self.record_header.pack(len(key)) + key + self.stats.pack(
+                        *[int(request_stats.get(submetric) or 0) for submetric in self.submetrics]))
+                #at most half of the slots are taken, which keeps probe sequences short
+                slot_count = 1
+                while slot_count < 2 * len(hashes):
+                    slot_count *= 2
+                slots = array('Q', bytes(self.slot.size * slot_count))
+                for key_hash, record_offset in zip(hashes, offsets):
+                    position = key_hash & (slot_count - 1)
+                    while slots[2 * position + 1]:
+                        position = (position + 1) & (slot_count - 1)
+                    slots[2 * position], slots[2 * position + 1] = key_hash, record_offset
+                if byteorder != "little":
+                    slots.byteswap()
+                slots_offset = index_file.tell()
+                index_file.write(slots.tobytes())
+                index_file.seek(0)
+                index_file.write(self.header.pack(self.magic, self.version, slot_count, len(hashes),
+                                                  slots_offset, time()))
+            replace(temporary_path, self.path)
+        except (IOError,PermissionError,NotADirectoryError):
+            print("Failed to write to file at {} .".format(self.path), file=stderr)
+            raise
+        finally:
+            if exists(temporary_path):
+                remove(temporary_path)
+
+
 class CheckJavamelodyHealth(nag.Resource):
+    #metrics which can be calculated from a single grab of part=jvm
+    jvm_metrics = ["heap_capacity_pct", "thread_capacity_pct", "file_descriptor_capacity_pct",
+                   "nonheap_memory_usage_total", "loaded_classes_count_total",
+                   "request_count_timed", "error_count_timed", "garbage_collection_timed"]
+    #metrics evaluated for a single request, see --request-path or --batch-request
+    path_metrics = ["duration_per_hit_on_path", "errors_per_hit_on_path", "response_size_per_hit_on_path",
+                    "duration_per_hit_on_path_timed", "errors_per_hit_on_path_timed",
+                    "response_size_per_hit_on_path_timed"]
+    request_submetrics = ["hits", "systemErrors", "responseSizesSum", "durationsSum"]
+    #calculation behind each per-path metric and its *_timed variant
+    path_metric_calculations = {"duration_per_hit_on_path": "_get_duration_per_hit",
+                                "errors_per_hit_on_path": "_get_errors_per_hit",
+                                "response_size_per_hit_on_path": "_get_response_size_per_hit"}
+    #metrics reporting the top_n requests across all endpoint types, see _get_top_requests
+    top_metrics = ["top_requests_by_duration_per_hit", "top_requests_by_duration_total", "top_requests_by_error_ratio"]
+    #metrics based on part heaphisto, the top_classes_* ones report top_n classes each
+    heaphisto_metrics = ["top_classes_by_bytes", "top_classes_by_growth_timed", "class_bytes_growth_timed"]
+    top_class_metrics = ["top_classes_by_bytes", "top_classes_by_growth_timed"]
+    #metrics based on part threads
+    thread_metrics = ["blocked_threads_count", "deadlocked_threads_count"]
+    #endpoint type of per-path metrics unless given by --endpoint-type
+    default_endpoint_type = "http"
+    endpoint_types = ['http', 'sql', 'jpa', 'ejb', 'spring',
+                      'guice', 'services', 'struts', 'jsf', 'jsp']
 
     def __init__(self,
                  metric,
@@ -37,22 +611,64 @@ class CheckJavamelodyHealth(nag.Resource):
                  scan=None,
                  request_path=None,
                  request_method=None,
-                 endpoint_type=None):
+                 endpoint_type=None,
+                 cache_max_age=0,
+                 collector_socket=None,
+                 batch_requests=None,
+                 rate_window=0,
+                 state_samples=100,
+                 top_n=5,
+                 min_hits=1,
+                 time_budget=None,
+                 stale_max_age=0,
+                 breaker_threshold=0,
+                 breaker_backoff=30,
+                 connection_pool=None,
+                 instrumentation=None,
+                 path_regex=None,
+                 class_name=None,
+                 index_max_age=0):
 
         self.url_timeout = url_timeout
+        self.connection_pool = connection_pool or JavamelodyConnectionPool(timeout=url_timeout)
+        self.instrumentation = instrumentation
         self.lapsize_in_secs = 60
-        self.metric = metric
+        #a metric asked for more than once is evaluated and reported once
+        self.metrics = [metric] if isinstance(metric, str) else list(OrderedDict.fromkeys(metric or []))
         self.tmpdir = tmpdir
         self.url = url #+ "?format=json&period=jour"
         self.uri_query = [("format", "json"), ("period", "jour")]
+        self.jvm_pid = None
+        self.state_store = JavamelodyStateStore(join(tmpdir or "", "state.sqlite"), max_samples=state_samples)
+        self.rate_window = rate_window
+        self.json_data_by_part = {}
+        self.recorded_requests = {}
+        self.recorded_request_deltas = {}
+        self.top_requests = {}
+        self.heap_histogram = None
+        self.thread_states = None
+        self.class_name = class_name
+        self.index_max_age = index_max_age
+        self.top_n = top_n
+        self.min_hits = min_hits
+        self.deadline_time = time() + time_budget if time_budget else None
+        self.stale_max_age = stale_max_age
+        self.served_stale = False
+        self.stale_response_age = 0
+        self.breaker_threshold = breaker_threshold
+        self.breaker_backoff = breaker_backoff
         self.min = min
         self.max = max
         self.scan = scan
         self.request_path = request_path
         self.request_method = request_method
         self.endpoint_type = endpoint_type
+        self.path_regex = re.compile(path_regex) if path_regex else None
+        self.cache_max_age = cache_max_age
+        self.collector_socket = collector_socket
+        self.batch_requests = batch_requests or []
         if self.scan:
-            self._prettyprint_available_endpoints(self._get_available_endpoints())
+            self._print_recorded_requests()
             exit()
             
     def _get_json_data(self,part=None):
@@ -63,28 +679,321 @@ class CheckJavamelodyHealth(nag.Resource):
         #valid_parts = ["threads", "counterSummaryPerClass", "heaphisto", "sessions",
         #               "mbeans", "jndi", "processes", "connections", "jvm", "database"]
 
-        if part:
-            self.uri_query.append(("part", part))
-        self.url = self.url + "?" + "&".join([item[0] + "=" + item[1] for item in self.uri_query])
+        #several metrics evaluated in one run share a single grab per part
+        if part in self.json_data_by_part:
+            return self.json_data_by_part[part]
+        url = self._get_url_for_part(part)
+        try:
+            response_file = self._get_shared_response(url)
+            if response_file is None and self.stale_max_age:
+                response_file = open(self._download_to_cache_file(url), "r")
+            if response_file is None:
+                response = self._grab_response(url)
+            else:
+                with response_file:
+                    response = response_file.read()
+        except (urllib.error.URLError, OSError):
+            stale_cache_path = self._get_stale_cache_path(url)
+            if not stale_cache_path:
+                raise
+            with open(stale_cache_path, "r") as cache_file:
+                response = cache_file.read()
+        with self._measure("parse"):
+            self.json_data_by_part[part] = json.loads(response)
+        return self.json_data_by_part[part]
+
+    def _get_json_stream(self, part=None):
+        """Like _get_json_data, but returns a JsonStream to parse the response while it's being received.
+        Responses handed out by the collector are parsed while being read from its socket.
+        Responses for the cache or kept for the stale fallback are written to disk while being received
+        and parsed from there, so memory usage doesn't grow with the size of the response either way."""
+        url = self._get_url_for_part(part)
+        try:
+            response_file = self._get_shared_response(url)
+            if response_file is not None:
+                return JsonStream(response_file)
+            if self.stale_max_age:
+                return JsonStream(open(self._download_to_cache_file(url), "r"))
+            return JsonStream(self._open_response(url))
+        except (urllib.error.URLError, OSError):
+            stale_cache_path = self._get_stale_cache_path(url)
+            if not stale_cache_path:
+                raise
+            return JsonStream(open(stale_cache_path, "r"))
+
+    def _get_shared_response(self, url):
+        """returns a file object to read the response for url from the collector or the cache,
+        None if neither is in use"""
+        response_file = self._open_response_from_collector(url) if self.collector_socket else None
+        if response_file is None and self.cache_max_age:
+            response_file = self._open_cached_response(url)
+        return response_file
+
+    def _open_response(self, url):
+        """returns a JavamelodyResponseReader for url, the circuit breaker learns whether the response
+        arrived completely once it's read or closed"""
+        return JavamelodyResponseReader(self._open_url(url), self.instrumentation, self._record_grab_result)
+
+    def _open_url(self, url):
+        """opens url unless the circuit breaker for this javamelody instance is open,
+        the timeout is cut down to what is left of the time budget"""
+        self._check_circuit_breaker()
+        timeout = self._get_url_timeout()
+        if timeout <= 0:
+            print("Time budget exhausted, not grabbing data from {} .".format(url), file=stderr)
+            raise urllib.error.URLError("time budget exhausted")
+        try:
+            with self._measure("connect"):
+                response = self.connection_pool.open(url, timeout=timeout, deadline_time=self.deadline_time)
+        except (urllib.error.HTTPError, urllib.error.URLError, TypeError, OSError):
+            print("Failed to grab data from {} .".format(url), file=stderr)
+            self._record_grab_result(False)
+            raise
+        return response
+
+    def _get_url_timeout(self):
+        """returns url_timeout cut down to what is left of the time budget"""
+        if not self.deadline_time:
+            return self.url_timeout
+        return min(self.url_timeout, self.deadline_time - time())
+
+    def _get_breaker_path(self):
+        from hashlib import sha1
+        return join(self.tmpdir, "breaker", sha1(self.url.encode('utf-8')).hexdigest())
+
+    def _get_breaker_state(self):
+        try:
+            with open(self._get_breaker_path(), "r") as breaker_file:
+                return json.load(breaker_file)
+        except (FileNotFoundError,ValueError):
+            return {"failures": 0, "open_until": 0}
+
+    def _check_circuit_breaker(self):
+        """After breaker_threshold consecutive failures, javamelody is left alone for breaker_backoff seconds,
+        doubled with every further failure (up to 16 times), so a struggling jvm isn't hammered any further."""
+        if not self.breaker_threshold:
+            return
+        breaker_state = self._get_breaker_state()
+        if breaker_state["open_until"] > time():
+            print("Circuit breaker for {} open after {} consecutive failures, next try in {}s .".format(
+                self.url, breaker_state["failures"], int(breaker_state["open_until"] - time())), file=stderr)
+            raise urllib.error.URLError("circuit breaker open")
+
+    def _record_grab_result(self, success):
+        if not self.breaker_threshold:
+            return
+        breaker_state = self._get_breaker_state()
+        if success and not breaker_state["failures"]:
+            return
+        if success:
+            breaker_state = {"failures": 0, "open_until": 0}
+        else:
+            breaker_state["failures"] += 1
+            if breaker_state["failures"] >= self.breaker_threshold:
+                breaker_state["open_until"] = time() + self.breaker_backoff * 2 ** min(
+                    breaker_state["failures"] - self.breaker_threshold, 4)
+        breaker_path = self._get_breaker_path()
         try:
-            response = urlopen(self.url, timeout=self.url_timeout)
-        except (urllib.error.HTTPError, urllib.error.URLError, TypeError):
-            print("Failed to grab data from {} .".format(self.url), file=stderr)
+            if not isdir(dirname(breaker_path)):
+                makedirs(dirname(breaker_path), exist_ok=True)
+            with open(breaker_path, "w") as breaker_file:
+                json.dump(breaker_state, breaker_file)
+        except (IOError,PermissionError,NotADirectoryError):
+            print("Failed to write to file at {} .".format(breaker_path), file=stderr)
             raise
-        response = response.read().decode('utf-8').replace('\0', '')
-        return json.loads(response)
+
+    def _measure(self, phase):
+        """see CheckJavamelodyHealthInstrumentation"""
+        return self.instrumentation.measure(phase) if self.instrumentation else nullcontext()
+
+    def _grab_response(self, url):
+        response = self._open_response(url)
+        try:
+            return "".join(iter(partial(response.read, JsonStream.chunk_size), ""))
+        finally:
+            response.close()
+
+    def _get_url_for_part(self, part=None):
+        uri_query = self.uri_query + [("part", part)] if part else self.uri_query
+        return self.url + "?" + "&".join([item[0] + "=" + item[1] for item in uri_query])
+
+    def _open_response_from_collector(self, url):
+        """asks a running collector (see CheckJavamelodyHealthCollector) for url, returns a file object to read
+        the response from, None if the collector is unavailable, so the caller can grab from javamelody instead"""
+        reply = self._ask_collector({"url": url})
+        return io.TextIOWrapper(reply, encoding='utf-8') if reply is not None else None
+
+    def _get_requests_from_collector(self, request_keys):
+        """returns {request_key: stats} for request_keys as kept by the collector, None if it's unavailable"""
+        request_keys = list(request_keys)
+        reply = self._ask_collector({"url": self._get_url_for_part(),
+                                        "requests": [list(request_key) for request_key in request_keys]})
+        if reply is None:
+            return None
+        with reply:
+            return dict(zip(request_keys, json.load(reply)))
+
+    def _ask_collector(self, query):
+        """sends query (a json object holding url and, for counters, the requests wanted) to the collector,
+        returns a binary file object to read its reply from (past the status line),
+        None if the collector is unavailable or failed to grab"""
+        timeout = self._get_url_timeout()
+        if timeout <= 0:
+            print("Time budget exhausted, not asking collector at {} .".format(self.collector_socket), file=stderr)
+            return None
+        import socket
+        collector = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        collector.settimeout(timeout)
+        reply = None
+        try:
+            collector.connect(self.collector_socket)
+            collector.sendall(json.dumps(query).encode('utf-8') + b"\n")
+            reply = collector.makefile("rb")
+            status = reply.readline()
+        except OSError:
+            print("Failed to reach collector at {} , grabbing data directly.".format(self.collector_socket), file=stderr)
+            if reply is not None:
+                reply.close()
+            return None
+        finally:
+            #the socket stays open until the reply is closed as well
+            collector.close()
+        if not status.startswith(b"OK"):
+            print("Collector failed to grab data from {} : {}".format(
+                query["url"], status[3:].decode('utf-8').strip()), file=stderr)
+            reply.close()
+            return None
+        return reply
+
+    def _get_cache_path(self, url):
+        """url contains part and period, so the hash of it serves as cache key"""
+        from hashlib import sha1
+        cache_dir = join(self.tmpdir, "cache")
+        try:
+            if not isdir(cache_dir):
+                makedirs(cache_dir, exist_ok=True)
+        except PermissionError:
+            print("Failed to create directory {} .".format(cache_dir), file=stderr)
+            raise
+        return join(cache_dir, sha1(url.encode('utf-8')).hexdigest())
+
+    def _get_stale_cache_path(self, url):
+        """Returns the path of the cached response for url regardless of cache_max_age if it isn't older
+        than stale_max_age, None otherwise. Serving it is noted in the output, see CheckJavamelodyHealthSummary."""
+        if not self.stale_max_age:
+            return None
+        cache_path = self._get_cache_path(url)
+        try:
+            response_age = time() - getmtime(cache_path)
+        except FileNotFoundError:
+            return None
+        if response_age > self.stale_max_age:
+            return None
+        print("Using stale data from {}s ago for {} .".format(int(response_age), url), file=stderr)
+        self.served_stale = True
+        self.stale_response_age = max(self.stale_response_age, int(response_age))
+        return cache_path
+
+    def _download_to_cache_file(self, url):
+        """Writes the response for url to the cache while it's being received, to a temporary file first,
+        so readers without lock never see a partially written response. A response failing to arrive completely
+        or failing _validate_response is dropped."""
+        cache_path = self._get_cache_path(url)
+        temporary_path = "{}.{}.tmp".format(cache_path, getpid())
+        response = self._open_response(url)
+        first_chunk = last_chunk = ""
+        try:
+            with open(temporary_path, "w") as cache_file:
+                for chunk in iter(partial(response.read, JsonStream.chunk_size), ""):
+                    if not first_chunk.strip():
+                        first_chunk = chunk
+                    if chunk.strip():
+                        last_chunk = chunk
+                    cache_file.write(chunk)
+            self._validate_response(url, first_chunk, last_chunk)
+            replace(temporary_path, cache_path)
+        except urllib.error.URLError:
+            print("Failed to grab data from {} .".format(url), file=stderr)
+            raise
+        except (IOError,PermissionError,NotADirectoryError):
+            print("Failed to write to file at {} .".format(cache_path), file=stderr)
+            raise
+        finally:
+            response.close()
+            if exists(temporary_path):
+                remove(temporary_path)
+        return cache_path
+
+    def _open_cached_response(self, url):
+        """Returns a file object to read the response for url from the cache in tmpdir, downloaded first
+        if it's older than self.cache_max_age. Concurrent executions for the same url wait on a lock,
+        so only one of them grabs from javamelody while the others read the stored response afterwards."""
+        cache_path = self._get_cache_path(url)
+        with open(cache_path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if not self._is_cache_file_fresh(cache_path):
+                    self._download_to_cache_file(url)
+                #opened while locked, replacing or evicting the file later on doesn't affect the reader
+                cache_file = open(cache_path, "r")
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self._evict_stale_cache_files(dirname(cache_path))
+        return cache_file
+
+    def _validate_response(self, url, response_start, response_end):
+        """Javamelody responds with a single json object. Anything else, e.g. the error page of a proxy
+        or a truncated response, must not be cached, as every execution within cache_max_age would fail on it.
+        Responses are written while being received, so they're checked by their first and last chunk."""
+        if not response_start.lstrip().startswith("{") or not response_end.rstrip().endswith("}"):
+            print("Invalid response from {} , not caching it.".format(url), file=stderr)
+            raise urllib.error.URLError("invalid response")
+
+    def _is_cache_file_fresh(self, cache_path):
+        """returns False if there is no cached response or it's older than self.cache_max_age"""
+        try:
+            return time() - getmtime(cache_path) <= self.cache_max_age
+        except FileNotFoundError:
+            return False
+
+    def _evict_stale_cache_files(self, cache_dir):
+        """removes cached responses older than self.cache_max_age (or self.stale_max_age if longer),
+        entries currently locked are left alone"""
+        max_age = max(self.cache_max_age, self.stale_max_age)
+        for filename in listdir(cache_dir):
+            cache_path = join(cache_dir, filename)
+            if filename.endswith((".lock", ".tmp")):
+                continue
+            try:
+                if time() - getmtime(cache_path) <= max_age:
+                    continue
+                with open(cache_path + ".lock", "a") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    try:
+                        if time() - getmtime(cache_path) > max_age:
+                            remove(cache_path)
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            except (FileNotFoundError,PermissionError):
+                continue
 
     def _evaluate_with_historical_metric(self,metric,current_value):
-        """Compares metric with numerical value current_value to a value previously stored in a file,
-        as to make metrics such as total request count useful for monitoring."""
-        current_time = int(time())
+        """Compares metric with numerical value current_value to a value previously stored in the state store,
+        as to make metrics such as total request count useful for monitoring.
+        The value compared to is the oldest one within self.rate_window seconds,
+        the one of the previous execution if there is none (or self.rate_window is 0)."""
+        current_time = time()
         try:
-            _, historic_time, historic_value = self._get_json_metric_from_file(metric)
+            historic_time, historic_value = self.state_store.get_reference_sample(
+                self._get_state_key(metric), current_time - self.rate_window if self.rate_window else current_time)
         except TypeError:
             #upon first execution, no historic value can be compared
             #to prevent extreme values (current_value - 0) we use 0
-            print("No historical value found for metric {} in file {} .".format(
-                metric, join(self.tmpdir, metric)), file=stderr)
+            print("No historical value found for metric {} in {} .".format(
+                metric, self.state_store.path), file=stderr)
             return 0
         else:
             time_difference = current_time - historic_time
@@ -95,103 +1004,316 @@ class CheckJavamelodyHealth(nag.Resource):
             else:
                 return 0
 
-    def _get_tmpdir_file_prefix(self):
+    def _get_state_key(self, metric):
+        """Values are stored per javamelody instance and jvm, a restarted jvm (new pid) starts over.
+        The url is part of the key, as jvms of different instances might share a pid (e.g. 1 in containers)."""
         if not self.jvm_pid:
             json_data = self._get_json_data("jvm")
             self.jvm_pid = json_data["list"][-1]["pid"]
-        return self.jvm_pid
+        return "_".join([str(self.url), str(self.jvm_pid), metric])
+
+    def _store_historical_metric(self, metric, value):
+        self.state_store.add_sample(self._get_state_key(metric), value, time())
 
-    def _get_absolute_path_for_tmpfile(self, metric):
+    def _print_recorded_requests(self):
+        """Prints a json object per request recorded by javamelody (JSON Lines) while the counters are parsed,
+        so memory usage doesn't grow with the amount of requests. Requests are filtered by endpoint_type
+        (all if not set), path_regex, request_path with request_method and min_hits."""
+        endpoint_types = [self.endpoint_type] if self.endpoint_type else self.endpoint_types
+        joined_request_path = " ".join([self.request_path, self.request_method]) if self.request_path else None
+        json_stream = self._get_json_stream()
         try:
-            return self.tmpfile_absolute_path
-        except AttributeError:
-            filename = "_".join([self._get_tmpdir_file_prefix(), metric])
-            self.tmpfile_absolute_path = join(self.tmpdir, filename)
-            return self.tmpfile_absolute_path
+            for endpoint_type, request_name, request_stats in self._iter_recorded_requests(json_stream,
+                                                                                         endpoint_types):
+                if joined_request_path and request_name != joined_request_path:
+                    continue
+                if self.path_regex and not self.path_regex.search(request_name):
+                    continue
+                if (request_stats.get("hits") or 0) < self.min_hits:
+                    continue
+                recorded_request = OrderedDict([("endpoint_type", endpoint_type), ("request", request_name)])
+                for submetric in self.request_submetrics:
+                    recorded_request[submetric] = request_stats.get(submetric)
+                print(json.dumps(recorded_request))
+        except BrokenPipeError:
+            #output piped into e.g. head, no need to go on
+            with open(devnull, "w") as null_file:
+                dup2(null_file.fileno(), stdout.fileno())
+        finally:
+            json_stream.close()
 
-    def _get_json_metric_from_file(self, metric):
-        """read a metric which has been saved in a file from a previous run of the script"""
-        absolute_filepath = self._get_absolute_path_for_tmpfile(metric)
+    @staticmethod
+    def _iter_recorded_requests(json_stream, endpoint_types):
+        """Yields (endpoint_type, request name, request stats) for the requests recorded by the counters
+        of endpoint_types (any counter if None) while json_stream is parsed, requests of other counters are skipped.
+        Javamelody puts the name of a counter before its requests, if not, the requests are held back
+        until the name is known."""
+        for key in json_stream.iter_object():
+            if key != "list":
+                json_stream.skip_value()
+                continue
+            for _ in json_stream.iter_array():
+                if json_stream.peek() != "{":
+                    json_stream.skip_value()
+                    continue
+                counter_name = None
+                held_back_requests = []
+                for counter_key in json_stream.iter_object():
+                    if counter_key == "name":
+                        counter_name = json_stream.decode_value()
+                    elif counter_key == "requests" and counter_name is None:
+                        held_back_requests = json_stream.decode_value()
+                    elif counter_key == "requests" and (endpoint_types is None or counter_name in endpoint_types):
+                        for _ in json_stream.iter_array():
+                            recorded_request = json_stream.decode_value()
+                            yield counter_name, recorded_request[0], recorded_request[1]
+                    else:
+                        json_stream.skip_value()
+                if endpoint_types is None or counter_name in endpoint_types:
+                    for recorded_request in held_back_requests:
+                        yield counter_name, recorded_request[0], recorded_request[1]
+
+    def _lookup_recorded_requests(self, request_keys):
+        """Looks up the stats of every (endpoint_type, request name) tuple of request_keys in a single pass
+        over the counter data, parsing stops as soon as all of them are found.
+        Requests javamelody didn't record (yet) are stored as None."""
+        missing_request_keys = set(request_keys) - set(self.recorded_requests)
+        if not missing_request_keys:
+            return
+        self.recorded_requests.update(dict.fromkeys(missing_request_keys))
+        if self.collector_socket:
+            recorded_requests = self._get_requests_from_collector(missing_request_keys)
+            if recorded_requests is not None:
+                self.recorded_requests.update(recorded_requests)
+                return
+        if self.index_max_age:
+            self._lookup_indexed_requests(missing_request_keys)
+            return
+        endpoint_types = {endpoint_type for endpoint_type, _ in missing_request_keys}
+        json_stream = self._get_json_stream()
         try:
-            with open(absolute_filepath, "r") as metric_file:
-                try:
-                    metric_data = json.load(metric_file)
-                except TypeError:
-                    print("Failed to read json from file at {} .".format(absolute_filepath), file=stderr)
-                    return None
-                else:
-                    return metric_data
-        except FileNotFoundError:
-            print("Failed to open file at {} .".format(absolute_filepath), file=stderr)
-            return None
-        except PermissionError:
-            print("Failed to open file at {} missing permission.".format(absolute_filepath), file=stderr)
-            return None
+            for request_key in self._iter_recorded_requests(json_stream, endpoint_types):
+                if request_key[:2] in missing_request_keys:
+                    self.recorded_requests[request_key[:2]] = request_key[2]
+                    missing_request_keys.remove(request_key[:2])
+                    if not missing_request_keys:
+                        break
+        finally:
+            json_stream.close()
+
+    def _lookup_indexed_requests(self, request_keys):
+        """Looks up request_keys in the request index of this javamelody instance and period (see
+        JavamelodyRequestIndex). An index older than index_max_age is rebuilt by a pass over all counters,
+        concurrent executions wait for the one rebuilding it and use the new index afterwards."""
+        request_index = JavamelodyRequestIndex(self._get_index_path())
+        try:
+            if not request_index.is_fresh(self.index_max_age):
+                with open(request_index.path + ".lock", "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        if not request_index.is_fresh(self.index_max_age):
+                            request_index.close()
+                            request_index.write(self._iter_requests_to_index(request_keys))
+                            return
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            for request_key in request_keys:
+                self.recorded_requests[request_key] = request_index.lookup(request_key)
+        finally:
+            request_index.close()
+
+    def _iter_requests_to_index(self, request_keys):
+        """yields every request recorded by javamelody for the index, picking up the ones of request_keys on the way.
+        Requests of every counter are indexed, not only those of endpoint_types (e.g. javamelody's job counter)."""
+        json_stream = self._get_json_stream()
+        try:
+            for endpoint_type, request_name, request_stats in self._iter_recorded_requests(json_stream, None):
+                if (endpoint_type, request_name) in request_keys:
+                    self.recorded_requests[(endpoint_type, request_name)] = request_stats
+                yield (endpoint_type, request_name), request_stats
+        finally:
+            json_stream.close()
 
-    def _write_json_metric_to_file(self, metric, value):
-        """also tries to create dir if it doesnt exist already"""
-        absolute_filepath = self._get_absolute_path_for_tmpfile(metric)
-        current_unixtime = int(time())
+    def _get_index_path(self):
+        """the url of the counters contains the period, so the hash of it identifies instance and period"""
+        from hashlib import sha1
+        index_dir = join(self.tmpdir, "index")
         try:
-            if not isdir(self.tmpdir):
-                makedirs(self.tmpdir, exist_ok=True)
+            if not isdir(index_dir):
+                makedirs(index_dir, exist_ok=True)
         except PermissionError:
-            print("Failed to create directory {} .".format(self.tmpdir), file=stderr)
+            print("Failed to create directory {} .".format(index_dir), file=stderr)
             raise
+        return join(index_dir, sha1(self._get_url_for_part().encode('utf-8')).hexdigest())
+
+    def _get_default_request_key(self):
+        return (self.endpoint_type or self.default_endpoint_type, " ".join([self.request_path, self.request_method]))
+
+    def _get_recorded_request(self, request_key=None):
+        """Returns the stats of the request given by request_key (endpoint_type, request name),
+        defaults to the request given by endpoint_type, request_path and request_method."""
+        if not request_key:
+            request_key = self._get_default_request_key()
+        self._lookup_recorded_requests([request_key])
+        return self.recorded_requests[request_key]
+
+    def _get_recorded_request_delta(self, request_key=None):
+        """Returns the difference between the current stats of the request given by request_key
+        (see _get_recorded_request) and the ones stored by a previous execution (or the oldest within
+        self.rate_window), so only hits since then are evaluated. Javamelody resets its counters for
+        period jour at midnight, a jvm restart resets them as well. If any stat decreased, the current
+        stats are counted since the reset and therefore used as they are."""
+        if not request_key:
+            request_key = self._get_default_request_key()
+        if request_key in self.recorded_request_deltas:
+            return self.recorded_request_deltas[request_key]
+        recorded_request = self._get_recorded_request(request_key) or dict.fromkeys(self.request_submetrics, 0)
+        current_time = time()
+        state_keys = {submetric: " ".join((self.url,) + request_key + (submetric,))
+                      for submetric in self.request_submetrics}
+        delta = {}
+        for submetric, state_key in state_keys.items():
+            historic_sample = self.state_store.get_reference_sample(
+                state_key, current_time - self.rate_window if self.rate_window else current_time)
+            if historic_sample is None:
+                #upon first execution, no historic value can be compared
+                print("No historical value found for {} in {} .".format(state_key, self.state_store.path), file=stderr)
+                delta = dict.fromkeys(self.request_submetrics, 0)
+                break
+            delta[submetric] = recorded_request[submetric] - historic_sample[1]
+        if any(value < 0 for value in delta.values()):
+            delta = {submetric: recorded_request[submetric] for submetric in self.request_submetrics}
+        self.state_store.add_samples({state_keys[submetric]: recorded_request[submetric]
+                                      for submetric in self.request_submetrics}, current_time)
+        self.recorded_request_deltas[request_key] = delta
+        return delta
+
+    def _get_top_requests(self, metric):
+        """Ranks the requests of all endpoint types for every top_requests_* metric of self.metrics
+        in a single pass over the counter data. Only the top_n requests with at least min_hits hits
+        are kept per metric (bounded heaps), returns (score, endpoint_type, request name) tuples for metric."""
+        if metric in self.top_requests:
+            return self.top_requests[metric]
+        rankings = {top_metric: [] for top_metric in self.top_metrics if top_metric in self.metrics + [metric]}
+        json_stream = self._get_json_stream()
         try:
-            with open(absolute_filepath, "w") as metric_file:
-                json.dump((metric, current_unixtime, value), metric_file)
-        except (IOError,PermissionError,NotADirectoryError):
-            print("Failed to write to file at {} .".format(absolute_filepath), file=stderr)
-            raise
+            for endpoint_type, request_name, request_stats in self._iter_recorded_requests(json_stream,
+                                                                                          self.endpoint_types):
+                hits = request_stats["hits"]
+                if not hits or hits < self.min_hits:
+                    continue
+                scores = {"top_requests_by_duration_per_hit": request_stats["durationsSum"] / hits,
+                          "top_requests_by_duration_total": request_stats["durationsSum"],
+                          "top_requests_by_error_ratio": request_stats["systemErrors"] / hits * 100}
+                for top_metric, ranking in rankings.items():
+                    if len(ranking) < self.top_n:
+                        heapq.heappush(ranking, (scores[top_metric], endpoint_type, request_name))
+                    elif scores[top_metric] > ranking[0][0]:
+                        heapq.heapreplace(ranking, (scores[top_metric], endpoint_type, request_name))
+        finally:
+            json_stream.close()
+        for top_metric, ranking in rankings.items():
+            self.top_requests[top_metric] = sorted(ranking, reverse=True)
+        return self.top_requests[metric]
 
-    def _prettyprint_available_endpoints(self, endpoints):
-        print(json.dumps(endpoints, sort_keys=True, indent=4))
-
-    def _get_available_endpoints(self, endpoint_type=None):
-        """Javamelody presents several metrics of type valid_endpoint_types , e.g. for http these might encompass
-        requests to different paths"""
-        if isinstance(endpoint_type, str):
-            endpoint_type = [endpoint_type]
-        valid_endpoint_types = ['http', 'sql', 'jpa', 'ejb', 'spring',
-                                'guice', 'services', 'struts', 'jsf',
-                                'jsp'] if not endpoint_type else endpoint_type
-        json_data = self._get_json_data()
-        try:
-            application_name = json_data["list"][0]["application"].split("_")[0]
-        except (TypeError,IndexError):
-            print("Failed to grab application name from json data.", file=stderr)
-            raise
-        endpoints = {"application": application_name,"endpoint_types": []}
+    def _get_top_requests_metric_dicts(self, metric, uom, digits, max=None):
+        metric_dicts = []
+        for score, endpoint_type, request_name in self._get_top_requests(metric):
+            #sql statements make for rather long labels
+            if len(request_name) > 80:
+                request_name = request_name[:77] + "..."
+            metric_dicts.append({
+                "value": round(score, digits),
+                "name": get_perfdata_label(" ".join([endpoint_type, request_name, metric])),
+                "context": metric,
+                "uom": uom,
+                "min": 0,
+                "max": max})
+        return metric_dicts
 
-        for endpoint_dict in json_data["list"]:
-            if endpoint_dict.get("name", "NONE") not in valid_endpoint_types:
-                continue
+    def _get_heap_histogram(self):
+        """Walks the classes of part heaphisto once for all heaphisto metrics, keeping only the top_n classes
+        by bytes and by growth (bounded heaps). For the *_growth_timed metrics the size of every class is stored
+        as packed (hash of class name, bytes) pairs in the state store and compared to those of the previous
+        execution. Javamelody reports the shallow size of the instances of a class, not their retained size."""
+        if self.heap_histogram is not None:
+            return self.heap_histogram
+        growth_wanted = any(metric in self.metrics for metric in ["top_classes_by_growth_timed",
+                                                                  "class_bytes_growth_timed"])
+        current_time = time()
+        previous_sizes = {}
+        time_difference = 0
+        if growth_wanted:
+            snapshot_key = self._get_state_key("heaphisto")
+            snapshot = self.state_store.get_snapshot(snapshot_key)
+            if snapshot is None:
+                print("No previous heap histogram found in {} .".format(self.state_store.path), file=stderr)
             else:
-                endpoints["endpoint_types"].append(
-                    OrderedDict([("endpoint_type", endpoint_dict["name"]),
-                                 ("endpoint_size", len(endpoint_dict["requests"])),
-                                 ("requests",  self._get_available_requests(endpoint_dict,
-                                                                            specific_path=self.request_path,
-                                                                            specific_method=self.request_method))]
-                                )
-                )
-        return endpoints
-
-    def _get_available_requests(self, endpoint_dict, specific_path=None, specific_method=None):
-        """returns a dict of requests and removes some clutter in their metrics"""
-        requests = OrderedDict()
-        interesting_submetrics = ["hits", "systemErrors", "responseSizesSum", "durationsSum"]
-        joined_request_path = " ".join([specific_path, specific_method]) if specific_path else None
-
-        for recorded_request in endpoint_dict["requests"]:
-            if joined_request_path and recorded_request[0] != joined_request_path:
-                continue
-            requests[recorded_request[0]] = {}
-            for submetric in interesting_submetrics:
-                requests[recorded_request[0]][submetric] = recorded_request[1][submetric]
-        return requests
-    
+                packed_sizes = array('q')
+                packed_sizes.frombytes(snapshot[1])
+                previous_sizes = dict(zip(packed_sizes[0::2], packed_sizes[1::2]))
+                time_difference = current_time - snapshot[0]
+        current_sizes = array('q')
+        rankings = {"top_classes_by_bytes": [], "top_classes_by_growth_timed": []}
+        class_growth = 0
+        json_stream = self._get_json_stream("heaphisto")
+        try:
+            for heap_class in json_stream.iter_nested_objects("classes"):
+                class_name = heap_class.get("name")
+                class_bytes = heap_class.get("bytes") or 0
+                scores = {"top_classes_by_bytes": class_bytes}
+                if growth_wanted:
+                    class_name_hash = get_name_hash(class_name)
+                    current_sizes.extend((class_name_hash, class_bytes))
+                    if previous_sizes:
+                        scores["top_classes_by_growth_timed"] = class_bytes - previous_sizes.get(class_name_hash, 0)
+                        if class_name == self.class_name:
+                            class_growth = scores["top_classes_by_growth_timed"]
+                for top_metric, score in scores.items():
+                    ranking = rankings[top_metric]
+                    if len(ranking) < self.top_n:
+                        heapq.heappush(ranking, (score, class_name))
+                    elif score > ranking[0][0]:
+                        heapq.heapreplace(ranking, (score, class_name))
+        finally:
+            json_stream.close()
+        if growth_wanted:
+            self.state_store.set_snapshot(snapshot_key, current_sizes.tobytes(), current_time)
+        #growth is reported per self.lapsize_in_secs, just like the other *_timed metrics
+        per_lapsize = self.lapsize_in_secs / time_difference if time_difference else 0
+        self.heap_histogram = {
+            "top_classes_by_bytes": sorted(rankings["top_classes_by_bytes"], reverse=True),
+            "top_classes_by_growth_timed": [(growth * per_lapsize, class_name) for growth, class_name
+                                            in sorted(rankings["top_classes_by_growth_timed"], reverse=True)],
+            "class_bytes_growth_timed": class_growth * per_lapsize}
+        return self.heap_histogram
+
+    def _get_top_classes_metric_dicts(self, metric):
+        metric_dicts = []
+        for score, class_name in self._get_heap_histogram()[metric]:
+            metric_dicts.append({
+                "value": round(score),
+                "name": get_perfdata_label(" ".join([class_name, metric])),
+                "context": metric,
+                "uom": "B"})
+        return metric_dicts
+
+    def _get_thread_states(self):
+        """counts the threads of part threads per state in a single pass, deadlocked threads as "deadlocked" """
+        if self.thread_states is not None:
+            return self.thread_states
+        self.thread_states = {"deadlocked": 0}
+        json_stream = self._get_json_stream("threads")
+        try:
+            for thread in json_stream.iter_nested_objects():
+                thread_state = thread.get("state")
+                self.thread_states[thread_state] = self.thread_states.get(thread_state, 0) + 1
+                if thread.get("deadlocked"):
+                    self.thread_states["deadlocked"] += 1
+        finally:
+            json_stream.close()
+        return self.thread_states
+
     def _get_percentage(self, part, total):
         try:
             part = sum(part)
@@ -208,7 +1330,28 @@ class CheckJavamelodyHealth(nag.Resource):
         return ret_val
 
     def probe(self):
-        metric_dict = operator.methodcaller(self.metric)(self)
+        with self._measure("probe"):
+            yield from self._evaluate_metrics()
+
+    def _evaluate_metrics(self):
+        """evaluates every requested metric, metrics sharing a part of the javamelody api
+        are calculated from the same grab (see _get_json_data)"""
+        if self.batch_requests:
+            self._lookup_recorded_requests(self.batch_requests)
+        for metric in self.metrics:
+            if self.batch_requests and metric in self.path_metrics:
+                for request_key in self.batch_requests:
+                    metric_dict = operator.methodcaller(metric, request_key)(self)
+                    metric_dict["name"] = get_perfdata_label(" ".join(request_key + (metric,)))
+                    metric_dict["context"] = metric
+                    yield self._get_nag_metric(metric_dict)
+            elif metric in self.top_metrics or metric in self.top_class_metrics:
+                for metric_dict in operator.methodcaller(metric)(self):
+                    yield self._get_nag_metric(metric_dict)
+            else:
+                yield self._get_nag_metric(operator.methodcaller(metric)(self))
+
+    def _get_nag_metric(self, metric_dict):
         if self.min:
             metric_dict["min"] = self.min
         if self.max:
@@ -274,14 +1417,18 @@ class CheckJavamelodyHealth(nag.Resource):
             "uom": "c",
             "min": 0}
 
-    def duration_per_hit_on_path(self):
-        endpoint = self._get_available_endpoints(endpoint_type=self.endpoint_type)
-        joined_request_path = " ".join([self.request_path, self.request_method])
+    def duration_per_hit_on_path(self, request_key=None):
+        return self._get_duration_per_hit(self._get_recorded_request(request_key), "duration_per_hit_on_path")
+
+    def duration_per_hit_on_path_timed(self, request_key=None):
+        """like duration_per_hit_on_path, but only for hits since the previous execution (or within --rate-window)"""
+        return self._get_duration_per_hit(self._get_recorded_request_delta(request_key), "duration_per_hit_on_path_timed")
 
+    def _get_duration_per_hit(self, recorded_request, name):
         try:
-            duration_sum_in_ms = endpoint["endpoint_types"][0]["requests"][joined_request_path]["durationsSum"]
-            total_hits = endpoint["endpoint_types"][0]["requests"][joined_request_path]["hits"]
-        except (KeyError,IndexError):
+            duration_sum_in_ms = recorded_request["durationsSum"]
+            total_hits = recorded_request["hits"]
+        except (KeyError,TypeError):
             #prevent UNKNOWN status when javamelody stats are reset
             duration_sum_in_ms = total_hits = 0
         try:
@@ -291,37 +1438,45 @@ class CheckJavamelodyHealth(nag.Resource):
 
         return {
             "value": metric_value,
-            "name": "duration_per_hit_on_path",
+            "name": name,
             "uom": "ms",
             "min": 0}
 
-    def errors_per_hit_on_path(self):
-        endpoint = self._get_available_endpoints(endpoint_type=self.endpoint_type)
-        joined_request_path = " ".join([self.request_path, self.request_method])
+    def errors_per_hit_on_path(self, request_key=None):
+        return self._get_errors_per_hit(self._get_recorded_request(request_key), "errors_per_hit_on_path")
+
+    def errors_per_hit_on_path_timed(self, request_key=None):
+        """like errors_per_hit_on_path, but only for hits since the previous execution (or within --rate-window)"""
+        return self._get_errors_per_hit(self._get_recorded_request_delta(request_key), "errors_per_hit_on_path_timed")
 
+    def _get_errors_per_hit(self, recorded_request, name):
         try:
-            total_errors = endpoint["endpoint_types"][0]["requests"][joined_request_path]["systemErrors"]
-            total_hits = endpoint["endpoint_types"][0]["requests"][joined_request_path]["hits"]
-        except (KeyError,IndexError):
+            total_errors = recorded_request["systemErrors"]
+            total_hits = recorded_request["hits"]
+        except (KeyError,TypeError):
             #prevent UNKNOWN status when javamelody stats are reset
             total_errors = total_hits = 0
 
         metric_value = self._get_percentage(total_errors, total_hits)
         return {
             "value": metric_value,
-            "name": "errors_per_hit_on_path",
+            "name": name,
             "uom": "%",
             "min": 0,
             "max": 100}
 
-    def response_size_per_hit_on_path(self):
-        endpoint = self._get_available_endpoints(endpoint_type=self.endpoint_type)
-        joined_request_path = " ".join([self.request_path, self.request_method])
+    def response_size_per_hit_on_path(self, request_key=None):
+        return self._get_response_size_per_hit(self._get_recorded_request(request_key), "response_size_per_hit_on_path")
 
+    def response_size_per_hit_on_path_timed(self, request_key=None):
+        """like response_size_per_hit_on_path, but only for hits since the previous execution (or within --rate-window)"""
+        return self._get_response_size_per_hit(self._get_recorded_request_delta(request_key), "response_size_per_hit_on_path_timed")
+
+    def _get_response_size_per_hit(self, recorded_request, name):
         try:
-            total_response_size = endpoint["endpoint_types"][0]["requests"][joined_request_path]["responseSizesSum"]
-            total_hits = endpoint["endpoint_types"][0]["requests"][joined_request_path]["hits"]
-        except (KeyError,IndexError):
+            total_response_size = recorded_request["responseSizesSum"]
+            total_hits = recorded_request["hits"]
+        except (KeyError,TypeError):
             #prevent UNKNOWN status when javamelody stats are reset
             total_response_size = total_hits = 0
         try:
@@ -331,10 +1486,58 @@ class CheckJavamelodyHealth(nag.Resource):
 
         return {
             "value": metric_value,
-            "name": "response_size_per_hit_on_path",
+            "name": name,
             "uom": "kB",
             "min": 0}
 
+    def top_requests_by_duration_per_hit(self):
+        """returns the top_n requests needing the most time on average"""
+        return self._get_top_requests_metric_dicts("top_requests_by_duration_per_hit", "ms", 1)
+
+    def top_requests_by_duration_total(self):
+        """returns the top_n requests the application spent the most time on in total"""
+        return self._get_top_requests_metric_dicts("top_requests_by_duration_total", "ms", 0)
+
+    def top_requests_by_error_ratio(self):
+        """returns the top_n requests with the highest percentage of failed hits"""
+        return self._get_top_requests_metric_dicts("top_requests_by_error_ratio", "%", 2, max=100)
+
+    def top_classes_by_bytes(self):
+        """returns the top_n classes whose instances occupy the most heap (shallow size)"""
+        return self._get_top_classes_metric_dicts("top_classes_by_bytes")
+
+    def top_classes_by_growth_timed(self):
+        """returns the top_n classes whose instances grew the most since the previous execution"""
+        metric_dicts = self._get_top_classes_metric_dicts("top_classes_by_growth_timed")
+        #upon first execution (or after a jvm restart) there is nothing to compare to, as for the other *_timed metrics
+        return metric_dicts or [{
+            "value": 0,
+            "name": "top_classes_by_growth_timed",
+            "context": "top_classes_by_growth_timed",
+            "uom": "B"}]
+
+    def class_bytes_growth_timed(self):
+        """returns the growth of the instances of class self.class_name since the previous execution"""
+        if not self.class_name:
+            print("Metric class_bytes_growth_timed requires --class-name .", file=stderr)
+            raise ValueError("no class name given")
+        return {
+            "value": round(self._get_heap_histogram()["class_bytes_growth_timed"]),
+            "name": "class_bytes_growth_timed",
+            "uom": "B"}
+
+    def blocked_threads_count(self):
+        return {
+            "value": self._get_thread_states().get("BLOCKED", 0),
+            "name": "blocked_threads_count",
+            "min": 0}
+
+    def deadlocked_threads_count(self):
+        return {
+            "value": self._get_thread_states()["deadlocked"],
+            "name": "deadlocked_threads_count",
+            "min": 0}
+
     def request_count_timed(self):
         """ returns an average of total requests received across self.lapsize_in_secs,
         calculated from a historic value read from a file and the current value from the web interface"""
@@ -342,7 +1545,7 @@ class CheckJavamelodyHealth(nag.Resource):
         self.jvm_pid = json_data["list"][-1]["pid"]
         current_value = json_data["list"][-1]["tomcatInformationsList"][0]["requestCount"]
         metric_value = self._evaluate_with_historical_metric("request_count_timed", current_value)
-        self._write_json_metric_to_file("request_count_timed", current_value)
+        self._store_historical_metric("request_count_timed", current_value)
         return {
             "value": metric_value,
             "name": "request_count_timed",
@@ -356,7 +1559,7 @@ class CheckJavamelodyHealth(nag.Resource):
         self.jvm_pid = json_data["list"][-1]["pid"]
         current_value = json_data["list"][-1]["tomcatInformationsList"][0]["errorCount"]
         metric_value = self._evaluate_with_historical_metric("error_count_timed",current_value)
-        self._write_json_metric_to_file("error_count_timed", current_value)
+        self._store_historical_metric("error_count_timed", current_value)
         return {
             "value": metric_value,
             "name": "error_count_timed",
@@ -370,7 +1573,7 @@ class CheckJavamelodyHealth(nag.Resource):
         self.jvm_pid = json_data["list"][-1]["pid"]
         current_value = json_data["list"][-1]["memoryInformations"]["garbageCollectionTimeMillis"]
         metric_value = self._evaluate_with_historical_metric("garbage_collection_timed",current_value)
-        self._write_json_metric_to_file("garbage_collection_timed",current_value)
+        self._store_historical_metric("garbage_collection_timed", current_value)
         return {
             "value": metric_value,
             "name": "garbage_collection_timed",
@@ -378,6 +1581,213 @@ class CheckJavamelodyHealth(nag.Resource):
             "min": 0}
 
 
+class CheckJavamelodyHealthTargets(nag.Resource):
+    """Evaluates the metrics of several javamelody instances (one CheckJavamelodyHealth per target)
+    concurrently with at most concurrency threads. Targets which fail or don't finish before
+    deadline (seconds) are counted by the metric unreachable_targets."""
+
+    def __init__(self, targets, concurrency=10, deadline=None):
+        self.targets = targets
+        self.concurrency = max(1, concurrency)
+        self.deadline = deadline
+
+    @property
+    def name(self):
+        return "CheckJavamelodyHealth"
+
+    @property
+    def served_stale(self):
+        return any(target.served_stale for target in self.targets)
+
+    @property
+    def stale_response_age(self):
+        return max(target.stale_response_age for target in self.targets)
+
+    def _evaluate_target(self, target):
+        return list(target.probe())
+
+    def _evaluate_targets(self, pending_targets, finished_targets):
+        import queue
+        while True:
+            try:
+                target = pending_targets.get_nowait()
+            except queue.Empty:
+                return
+            #any exception (e.g. sqlite3.Error from a corrupt state store) counts the target as unreachable,
+            #a target not reporting back would leave _evaluate_concurrently waiting for it forever
+            try:
+                finished_targets.put((target, self._evaluate_target(target)))
+            except Exception as e:
+                print("Failed to evaluate metrics for {} : {}".format(target.url, e), file=stderr)
+                finished_targets.put((target, None))
+
+    def _evaluate_concurrently(self):
+        """returns {target: result of _evaluate_target} for every target evaluated successfully before the deadline"""
+        import queue
+        pending_targets = queue.Queue()
+        finished_targets = queue.Queue()
+        for target in self.targets:
+            pending_targets.put(target)
+        #daemon threads, so targets still busy after the deadline don't prevent the plugin from exiting
+        for _ in range(min(self.concurrency, len(self.targets))):
+            threading.Thread(target=self._evaluate_targets, args=(pending_targets, finished_targets),
+                             daemon=True).start()
+        end_time = time() + self.deadline if self.deadline else None
+        results = {}
+        for finished in range(len(self.targets)):
+            try:
+                target, result = finished_targets.get(timeout=max(0, end_time - time()) if end_time else None)
+            except queue.Empty:
+                print("Deadline of {}s exceeded, {} targets did not respond in time.".format(
+                    self.deadline, len(self.targets) - finished), file=stderr)
+                break
+            if result is not None:
+                results[target] = result
+        return results
+
+    def _get_target_metric(self, target, metric):
+        return metric.replace(name=get_perfdata_label(" ".join([target.url, metric.name])))
+
+    def probe(self):
+        results = self._evaluate_concurrently()
+        for target in self.targets:
+            for metric in results.get(target, []):
+                yield self._get_target_metric(target, metric)
+        yield nag.Metric("unreachable_targets", len(self.targets) - len(results),
+                         uom="c", min=0, max=len(self.targets))
+
+
+class CheckJavamelodyHealthCluster(CheckJavamelodyHealthTargets):
+    """Evaluates the per-path metrics for a cluster of javamelody instances (nodes) serving the same application.
+    The stats of each request are summed over all nodes, so the metrics are weighted by the hits of each node.
+    The node with the highest value is reported as outlier with context METRIC_worst_node, which has no thresholds
+    unless given as METRIC_worst_node=RANGE. Other metrics are reported per node."""
+    worst_node_suffix = "_worst_node"
+
+    def __init__(self, targets, concurrency=10, deadline=None):
+        super(CheckJavamelodyHealthCluster, self).__init__(targets, concurrency=concurrency, deadline=deadline)
+        self.metrics = targets[0].metrics
+        #requests are looked up only if per-path metrics are asked for, -p is optional otherwise
+        self.request_keys = []
+        if any(metric in CheckJavamelodyHealth.path_metrics for metric in self.metrics):
+            self.request_keys = targets[0].batch_requests or [targets[0]._get_default_request_key()]
+
+    def _get_stats_sources(self):
+        """per-path metrics use the stats since midnight, their *_timed variants the delta to the last execution"""
+        return {metric.endswith("_timed") for metric in self.metrics if metric in CheckJavamelodyHealth.path_metrics}
+
+    def _evaluate_target(self, target):
+        """Returns the metrics of the node which aren't per-path and its stats of every request, flattened
+        into one array per stats source, index i * len(request_submetrics) holds the hits of request_keys[i]."""
+        if self.request_keys:
+            target._lookup_recorded_requests(self.request_keys)
+        node_stats = {}
+        for timed in self._get_stats_sources():
+            node_stats[timed] = array('d')
+            for request_key in self.request_keys:
+                if timed:
+                    recorded_request = target._get_recorded_request_delta(request_key)
+                else:
+                    recorded_request = target._get_recorded_request(request_key) or {}
+                node_stats[timed].extend(recorded_request.get(submetric, 0)
+                                         for submetric in CheckJavamelodyHealth.request_submetrics)
+        target.metrics = [metric for metric in target.metrics if metric not in CheckJavamelodyHealth.path_metrics]
+        return list(target.probe()), node_stats
+
+    def probe(self):
+        results = self._evaluate_concurrently()
+        for target in self.targets:
+            for metric in results.get(target, ([], {}))[0]:
+                yield self._get_target_metric(target, metric)
+        if results:
+            for metric_dict in self._get_cluster_metric_dicts(results):
+                yield self.targets[0]._get_nag_metric(metric_dict)
+        yield nag.Metric("unreachable_targets", len(self.targets) - len(results),
+                         uom="c", min=0, max=len(self.targets))
+
+    def _get_cluster_metric_dicts(self, results):
+        submetric_count = len(CheckJavamelodyHealth.request_submetrics)
+        cluster_stats = {}
+        for timed in self._get_stats_sources():
+            #element-wise sum over the arrays of all nodes
+            cluster_stats[timed] = array('d', map(sum, zip(*[node_stats[timed] for _, node_stats in results.values()])))
+        for metric in self.metrics:
+            if metric not in CheckJavamelodyHealth.path_metrics:
+                continue
+            timed = metric.endswith("_timed")
+            calculation = getattr(self.targets[0], CheckJavamelodyHealth.path_metric_calculations[
+                metric[:-len("_timed")] if timed else metric])
+            for index, request_key in enumerate(self.request_keys):
+                stats_slice = slice(index * submetric_count, (index + 1) * submetric_count)
+                label = " ".join(request_key + (metric,)) if self.targets[0].batch_requests else metric
+                metric_dict = calculation(dict(zip(CheckJavamelodyHealth.request_submetrics,
+                                                   cluster_stats[timed][stats_slice])), metric)
+                metric_dict.update(name=get_perfdata_label(label), context=metric)
+                yield metric_dict
+                node_values = [(calculation(dict(zip(CheckJavamelodyHealth.request_submetrics,
+                                                     node_stats[timed][stats_slice])), metric)["value"], target.url)
+                               for target, (_, node_stats) in results.items()]
+                worst_value, worst_url = max(node_values)
+                metric_dict = dict(metric_dict, value=worst_value, context=metric + self.worst_node_suffix,
+                                   name=get_perfdata_label(" ".join([label, "worst node", worst_url])))
+                yield metric_dict
+
+
+class CheckJavamelodyHealthInstrumentation(nag.Resource):
+    """Records wall time, bytes transferred and peak memory (maxrss of the process at the end of a phase)
+    for each phase of a run and reports them in -vvv output as well as performance data with context
+    "self_perfdata" if perfdata is set. Phases run several times, e.g. once per part or target, are summed up.
+    startup is the cpu time spent by the interpreter up to main, connect lasts until javamelody starts
+    to respond, transfer covers receiving and decoding the response, parse covers json.loads and probe
+    the whole evaluation. Streamed lookups parse while receiving, their parsing only shows up in probe."""
+    context = "self_perfdata"
+    phases = ["startup", "connect", "transfer", "parse", "probe"]
+
+    def __init__(self, startup_seconds, perfdata=True):
+        self.perfdata = perfdata
+        self.lock = threading.Lock()
+        self.phase_results = OrderedDict((phase, None) for phase in self.phases)
+        self.add("startup", startup_seconds)
+
+    @property
+    def name(self):
+        return "CheckJavamelodyHealth"
+
+    @contextmanager
+    def measure(self, phase):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, perf_counter() - start)
+
+    def add(self, phase, seconds, transferred_bytes=0):
+        maxrss = getrusage(RUSAGE_SELF).ru_maxrss * 1024
+        with self.lock:
+            phase_result = self.phase_results[phase] or {"seconds": 0, "bytes": 0, "maxrss": 0}
+            phase_result["seconds"] += seconds
+            phase_result["bytes"] += transferred_bytes
+            phase_result["maxrss"] = max(phase_result["maxrss"], maxrss)
+            self.phase_results[phase] = phase_result
+
+    def probe(self):
+        for phase, phase_result in self.phase_results.items():
+            if phase_result is None:
+                continue
+            logging.getLogger("nagiosplugin").debug("phase %s took %.4fs, %d bytes transferred, maxrss %d bytes",
+                                                    phase, phase_result["seconds"], phase_result["bytes"],
+                                                    phase_result["maxrss"])
+            if not self.perfdata:
+                continue
+            yield nag.Metric("self_{}_time".format(phase), round(phase_result["seconds"], 4),
+                             uom="s", min=0, context=self.context)
+            yield nag.Metric("self_{}_maxrss".format(phase), phase_result["maxrss"],
+                             uom="B", min=0, context=self.context)
+            if phase == "transfer":
+                yield nag.Metric("self_transfer_bytes", phase_result["bytes"],
+                                 uom="B", min=0, context=self.context)
+
+
 class CheckJavamelodyHealthContext(nag.ScalarContext):
     fmt_helper = {
         "heap_capacity_pct": "{value}{uom} of heap capacity exhausted.",
@@ -390,13 +1800,29 @@ class CheckJavamelodyHealthContext(nag.ScalarContext):
         "error_count_timed": "{value} errors encountered per minute .",
         "duration_per_hit_on_path": "{value}{uom} needed on average.",
         "errors_per_hit_on_path": "{value}{uom} of requests failed.",
-        "response_size_per_hit_on_path": "average response size at {value}{uom} ."}
+        "response_size_per_hit_on_path": "average response size at {value}{uom} .",
+        "duration_per_hit_on_path_timed": "{value}{uom} needed on average by recent requests.",
+        "errors_per_hit_on_path_timed": "{value}{uom} of recent requests failed.",
+        "response_size_per_hit_on_path_timed": "average response size of recent requests at {value}{uom} .",
+        "top_requests_by_duration_per_hit": "{value}{uom} needed on average.",
+        "top_requests_by_duration_total": "{value}{uom} spent in total.",
+        "top_requests_by_error_ratio": "{value}{uom} of requests failed.",
+        "top_classes_by_bytes": "{value}{uom} occupied by instances.",
+        "top_classes_by_growth_timed": "instances grew by {value}{uom} per minute.",
+        "class_bytes_growth_timed": "instances grew by {value}{uom} per minute.",
+        "blocked_threads_count": "{value} threads blocked.",
+        "deadlocked_threads_count": "{value} threads deadlocked.",
+        "unreachable_targets": "{value} targets failed to respond."}
 
     def __init__(self, name, warning=None, critical=None,
                  fmt_metric='{name} is {valueunit}', result_cls=nag.Result):
 
+        #the outliers of a cluster are described like the metric they belong to
+        base_name = name
+        if name.endswith(CheckJavamelodyHealthCluster.worst_node_suffix):
+            base_name = name[:-len(CheckJavamelodyHealthCluster.worst_node_suffix)]
         try:
-            metric_helper_text = CheckJavamelodyHealthContext.fmt_helper[name]
+            metric_helper_text = CheckJavamelodyHealthContext.fmt_helper[base_name]
         except KeyError:
             raise ValueError("Metric \"{}\" not found. Use --help to check for metrics available.".format(name))
         super(CheckJavamelodyHealthContext, self).__init__(name,
@@ -405,6 +1831,13 @@ class CheckJavamelodyHealthContext(nag.ScalarContext):
                                                            fmt_metric=metric_helper_text,
                                                            result_cls=result_cls)
 
+    def describe(self, metric):
+        """metrics sharing this context (e.g. one per request in batch mode) are told apart by their name"""
+        description = super(CheckJavamelodyHealthContext, self).describe(metric)
+        if metric.name != self.name:
+            return "{}: {}".format(metric.name, description)
+        return description
+
 
 class CheckJavamelodyHealthSummary(nag.Summary):
 
@@ -413,68 +1846,529 @@ class CheckJavamelodyHealthSummary(nag.Summary):
 
     def ok(self, results):
         if len(results.most_significant) > 1:
-            info_message = ", ".join([str(result) for result in results.results])
+            info_message = ", ".join([str(result) for result in self._get_reported_results(results)])
         else:
-            info_message = " ".join([str(result) for result in results.results])
-        return "\"{}\" reports: {}".format(self.url,info_message)
+            info_message = " ".join([str(result) for result in self._get_reported_results(results)])
+        return "\"{}\" reports{}: {}".format(self.url, self._get_stale_note(results), info_message)
 
     def problem(self, results):
         if len(results.most_significant) > 1:
-            info_message = " ,".join([str(result) for result in results.results])
+            info_message = " ,".join([str(result) for result in self._get_reported_results(results)])
+        else:
+            info_message = " ".join([str(result) for result in self._get_reported_results(results)])
+        return "\"{}\" reports{}: {}".format(self.url, self._get_stale_note(results), info_message)
+
+    def _get_reported_results(self, results):
+        """the plugin's own cost (see --self-perfdata) is reported as performance data only"""
+        return [result for result in results.results
+                if result.metric is None or result.metric.context != CheckJavamelodyHealthInstrumentation.context]
+
+    def _get_stale_note(self, results):
+        """metrics evaluated from a stale response (see --stale-max-age) are marked as such"""
+        stale_resources = [result.resource for result in results.results
+                           if getattr(result.resource, "served_stale", False)]
+        if not stale_resources:
+            return ""
+        return " (STALE, data from {}s ago)".format(max(resource.stale_response_age for resource in stale_resources))
+
+
+class CheckJavamelodyHealthCollector(object):
+    """Long running process which grabs javamelody responses on a schedule over kept-alive connections.
+    Executions of the plugin started with --collector-socket ask the collector instead of grabbing themselves.
+    Counters are parsed once per grab and kept as stats per request, executions evaluating per-path metrics
+    get the stats of their requests only. Other parts are handed out as grabbed. Every url requested by
+    an execution gets polled until no execution asked for it for idle_intervals intervals."""
+
+    def __init__(self, socket_path, interval=10, url_timeout=10, idle_intervals=10):
+        self.socket_path = socket_path
+        self.interval = interval
+        self.idle_intervals = idle_intervals
+        self.connection_pool = JavamelodyConnectionPool(timeout=url_timeout)
+        #url: {"grabbed": unixtime, "requested": unixtime, "data": see _grab, "error": str, "lock": Lock}
+        self.snapshots = {}
+        self.snapshots_lock = threading.Lock()
+
+    def _grab(self, url):
+        """returns counters (no part) as {endpoint_type: {request name: stats as tuple of request_submetrics}},
+        any other part as received"""
+        from urllib.parse import urlsplit,parse_qs
+        if "part" in parse_qs(urlsplit(url).query):
+            return self.connection_pool.get(url)
+        recorded_requests = {}
+        json_stream = JsonStream(JavamelodyResponseReader(self.connection_pool.open(url)))
+        try:
+            for endpoint_type, request_name, request_stats in CheckJavamelodyHealth._iter_recorded_requests(
+                    json_stream, None):
+                recorded_requests.setdefault(endpoint_type, {})[request_name] = tuple(
+                    request_stats.get(submetric) or 0 for submetric in CheckJavamelodyHealth.request_submetrics)
+        finally:
+            json_stream.close()
+        return recorded_requests
+
+    def _is_outdated(self, snapshot):
+        return snapshot["data"] is None or time() - snapshot["grabbed"] > 2 * self.interval
+
+    def get_snapshot(self, url):
+        """Returns the latest data for url, grabs it first if url is unknown or its data outdated.
+        Concurrent requests for the same url wait for the one grabbing instead of grabbing as well,
+        if that grab failed they fail right away."""
+        with self.snapshots_lock:
+            snapshot = self.snapshots.setdefault(url, {"grabbed": 0, "data": None, "error": None,
+                                                       "lock": threading.Lock()})
+            snapshot["requested"] = time()
+        if not self._is_outdated(snapshot):
+            return snapshot["data"]
+        with snapshot["lock"]:
+            if snapshot["error"] and time() - snapshot["grabbed"] < self.interval:
+                raise urllib.error.URLError(snapshot["error"])
+            if self._is_outdated(snapshot):
+                self._refresh(url, snapshot)
+            return snapshot["data"]
+
+    def _refresh(self, url, snapshot):
+        snapshot["grabbed"] = time()
+        try:
+            snapshot["data"] = self._grab(url)
+            snapshot["error"] = None
+        except Exception as e:
+            #never hand out outdated data, executions rather grab by themselves
+            snapshot["data"] = None
+            snapshot["error"] = str(e)
+            raise
+
+    def _poll(self):
+        while True:
+            with self.snapshots_lock:
+                for url, snapshot in list(self.snapshots.items()):
+                    if time() - snapshot["requested"] > self.idle_intervals * self.interval:
+                        del self.snapshots[url]
+                snapshots = list(self.snapshots.items())
+            for url, snapshot in snapshots:
+                if time() - snapshot["grabbed"] < self.interval:
+                    continue
+                try:
+                    with snapshot["lock"]:
+                        if time() - snapshot["grabbed"] >= self.interval:
+                            self._refresh(url, snapshot)
+                #anything escaping here would end polling for good
+                except Exception as e:
+                    print("Failed to grab data from {} : {}".format(url, e), file=stderr)
+            sleep(1)
+
+    def write_reply(self, query, wfile):
+        """Writes the stats of every request of query["requests"] (null for requests not recorded) if given,
+        the data for query["url"] otherwise. Counters are written with the stats of request_submetrics only."""
+        data = self.get_snapshot(query["url"])
+        if "requests" in query:
+            if not isinstance(data, dict):
+                raise ValueError("no counters at {}".format(query["url"]))
+            stats = [data.get(endpoint_type, {}).get(request_name) for endpoint_type, request_name in query["requests"]]
+            wfile.write(b"OK\n" + json.dumps([dict(zip(CheckJavamelodyHealth.request_submetrics, request_stats))
+                                               if request_stats else None for request_stats in stats]).encode('utf-8'))
+        elif isinstance(data, dict):
+            wfile.write(b"OK\n")
+            self._write_counters(data, wfile)
         else:
-            info_message = " ".join([str(result) for result in results.results])
-        return "\"{}\" reports: {}".format(self.url, info_message)
+            wfile.write(b"OK\n" + data.encode('utf-8'))
+
+    def _write_counters(self, recorded_requests, wfile):
+        """writes recorded_requests like javamelody would, in chunks of JsonStream.chunk_size"""
+        chunks = ['{"list": [']
+        chunks_size = 0
+        for index, (endpoint_type, requests) in enumerate(recorded_requests.items()):
+            chunks.append('{}{{"name": {}, "requests": ['.format(", " if index else "", json.dumps(endpoint_type)))
+            for request_index, (request_name, request_stats) in enumerate(requests.items()):
+                chunk = json.dumps([request_name, dict(zip(CheckJavamelodyHealth.request_submetrics, request_stats))])
+                chunks.append(", " + chunk if request_index else chunk)
+                chunks_size += len(chunk)
+                if chunks_size > JsonStream.chunk_size:
+                    wfile.write("".join(chunks).encode('utf-8'))
+                    chunks, chunks_size = [], 0
+            chunks.append("]}")
+        chunks.append("]}")
+        wfile.write("".join(chunks).encode('utf-8'))
+
+    def serve_forever(self):
+        import socketserver
+        collector = self
+
+        class CollectorRequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    collector.write_reply(json.loads(self.rfile.readline().decode('utf-8')), self.wfile)
+                except Exception as e:
+                    self.wfile.write("ERR {}\n".format(e).encode('utf-8'))
+
+        if exists(self.socket_path):
+            remove(self.socket_path)
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+        threading.Thread(target=self._poll, daemon=True).start()
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, CollectorRequestHandler)
+        chmod(self.socket_path, 0o660)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            remove(self.socket_path)
+
+
+class CheckJavamelodyHealthExporter(object):
+    """Serves the metrics of several javamelody instances for prometheus (text exposition format).
+    Javamelody is asked at most once per interval, scrapes in between get the previously rendered metrics.
+    Requests recorded by javamelody are exported as series labelled by endpoint type and request name,
+    those of endpoint_type (http by default) matching path_regex only, as every request makes a series per counter."""
+    #(name, metric, description), the _total suffix is reserved for counters in prometheus
+    gauge_metrics = [("heap_capacity_pct", "heap_capacity_pct", "percentage of heap capacity exhausted"),
+                     ("thread_capacity_pct", "thread_capacity_pct", "percentage of thread capacity exhausted"),
+                     ("file_descriptor_capacity_pct", "file_descriptor_capacity_pct",
+                      "percentage of max file descriptors in use"),
+                     ("nonheap_memory_usage", "nonheap_memory_usage_total", "non heap memory in use in MB"),
+                     ("loaded_classes_count", "loaded_classes_count_total", "classes currently loaded")]
+    #prometheus calculates rates itself, so the totals behind the *_timed metrics are exported as counters
+    jvm_counters = [("request_count", ["tomcatInformationsList", 0, "requestCount"], "requests received"),
+                    ("error_count", ["tomcatInformationsList", 0, "errorCount"], "errors encountered"),
+                    ("garbage_collection_time_ms", ["memoryInformations", "garbageCollectionTimeMillis"],
+                     "time spent on garbage collection in ms")]
+    request_counters = [("hits", "hits"), ("durations_ms", "durationsSum"),
+                        ("system_errors", "systemErrors"), ("response_sizes_bytes", "responseSizesSum")]
+
+    def __init__(self, urls, create_target, address, interval=15, min_hits=1):
+        self.urls = urls
+        self.create_target = create_target
+        host, _, port = address.rpartition(":")
+        self.address = (host, int(port))
+        self.interval = interval
+        self.min_hits = min_hits
+        self.rendered_metrics = None
+        self.rendered_time = 0
+        self.render_lock = threading.Lock()
+
+    def get_metrics(self):
+        """concurrent scrapes wait for the one refreshing the metrics instead of asking javamelody themselves"""
+        with self.render_lock:
+            if self.rendered_metrics is None or time() - self.rendered_time >= self.interval:
+                self.rendered_metrics = self._render_metrics()
+                self.rendered_time = time()
+            return self.rendered_metrics
+
+    def _render_metrics(self):
+        families = OrderedDict()
+        for url in self.urls:
+            #samples of a target failing halfway are dropped, so they don't show up next to up 0
+            target_families = OrderedDict()
+            try:
+                self._add_target_samples(target_families, url)
+            except (OSError,ValueError,LookupError,TypeError) as e:
+                print("Failed to evaluate metrics for {} : {}".format(url, e), file=stderr)
+                self._add_sample(families, "up", "gauge", "javamelody responded", {"instance": url}, 0)
+            else:
+                for name, (metric_type, description, samples) in target_families.items():
+                    families.setdefault(name, (metric_type, description, []))[2].extend(samples)
+                self._add_sample(families, "up", "gauge", "javamelody responded", {"instance": url}, 1)
+        lines = []
+        for name, (metric_type, description, samples) in families.items():
+            lines.append("# HELP javamelody_{} {}".format(name, description))
+            lines.append("# TYPE javamelody_{} {}".format(name, metric_type))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def _add_target_samples(self, families, url):
+        target = self.create_target([], url=url)
+        for name, metric, description in self.gauge_metrics:
+            metric_dict = operator.methodcaller(metric)(target)
+            self._add_sample(families, name, "gauge", description, {"instance": url}, metric_dict["value"])
+        jvm_data = target._get_json_data("jvm")["list"][-1]
+        for name, keys, description in self.jvm_counters:
+            value = jvm_data
+            for key in keys:
+                value = value[key]
+            self._add_sample(families, name + "_total", "counter", description, {"instance": url}, value)
+        endpoint_types = [target.endpoint_type or target.default_endpoint_type]
+        json_stream = target._get_json_stream()
+        try:
+            for endpoint_type, request_name, request_stats in target._iter_recorded_requests(json_stream,
+                                                                                            endpoint_types):
+                if request_stats["hits"] < self.min_hits:
+                    continue
+                if target.path_regex and not target.path_regex.search(request_name):
+                    continue
+                labels = {"instance": url, "endpoint_type": endpoint_type, "request": request_name}
+                for name, submetric in self.request_counters:
+                    self._add_sample(families, "request_{}_total".format(name), "counter",
+                                     "{} of requests since midnight".format(submetric), labels, request_stats[submetric])
+        finally:
+            json_stream.close()
+
+    def _add_sample(self, families, name, metric_type, description, labels, value):
+        samples = families.setdefault(name, (metric_type, description, []))[2]
+        samples.append("javamelody_{}{{{}}} {}".format(name, ",".join(
+            '{}="{}"'.format(label, self._escape_label_value(label_value)) for label, label_value in labels.items()),
+            value))
+
+    def _escape_label_value(self, label_value):
+        return str(label_value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def serve_forever(self):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        exporter = self
+
+        class ExporterRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.get_metrics().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+        server = ThreadingHTTPServer(self.address, ExporterRequestHandler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+def get_perfdata_label(text):
+    """performance data labels must not contain single quotes or equal signs"""
+    return text.replace("'", "_").replace("=", "_")
+
+
+def get_name_hash(name):
+    """64 bit hash of name, used to store class sizes (see _get_heap_histogram) and in JavamelodyRequestIndex"""
+    from hashlib import blake2b
+    return int.from_bytes(blake2b(str(name).encode('utf-8'), digest_size=8).digest(), "little", signed=True)
+
+
+def get_lines_from_file(filename):
+    """returns the stripped lines of filename, empty lines and lines starting with # are ignored"""
+    try:
+        with open(filename, "r") as list_file:
+            return [line.strip() for line in list_file if line.strip() and not line.lstrip().startswith("#")]
+    except (FileNotFoundError,PermissionError):
+        print("Failed to read file at {} .".format(filename), file=stderr)
+        raise
+
+
+def get_batch_requests(batch_requests, batch_file, default_endpoint_type):
+    """Returns (endpoint_type, request name) tuples for requests given as [ENDPOINT_TYPE:]PATH METHOD,
+    e.g. "/api/list_users GET" or "http:/api/list_users GET". batch_file lists one request per line."""
+    batch_requests = list(batch_requests or [])
+    if batch_file:
+        batch_requests.extend(get_lines_from_file(batch_file))
+    request_keys = []
+    for batch_request in batch_requests:
+        endpoint_type, _, request_name = batch_request.partition(":")
+        if endpoint_type not in CheckJavamelodyHealth.endpoint_types or not request_name:
+            endpoint_type, request_name = default_endpoint_type, batch_request
+        if (endpoint_type, request_name) not in request_keys:
+            request_keys.append((endpoint_type, request_name))
+    return request_keys
+
+
+def get_thresholds_per_metric(thresholds, metrics, defaults=None):
+    """thresholds are given either as RANGE (applies to every metric)
+    or as METRIC=RANGE (applies to METRIC only, takes precedence).
+    Metrics in defaults aren't affected by RANGE, only by METRIC=RANGE."""
+    thresholds_per_metric = dict(defaults or {})
+    thresholds_per_metric.update(dict.fromkeys(metrics, ''))
+    for threshold in thresholds or []:
+        if "=" not in threshold:
+            thresholds_per_metric.update(dict.fromkeys(metrics, threshold))
+    for threshold in thresholds or []:
+        if "=" in threshold:
+            metric, threshold_range = threshold.split("=", 1)
+            if metric not in thresholds_per_metric:
+                raise ValueError("Threshold given for metric \"{}\" which is not checked.".format(metric))
+            thresholds_per_metric[metric] = threshold_range
+    return thresholds_per_metric
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('-w', '--warning', metavar='RANGE', default='',
+    parser.add_argument('-w', '--warning', metavar='RANGE', action='append',
                         help='return warning if metric is outside RANGE,\
-                            RANGE is defined as an number or an interval, e.g. 5:25 or :30  or 95:')
-    parser.add_argument('-c', '--critical', metavar='RANGE', default='',
+                            RANGE is defined as an number or an interval, e.g. 5:25 or :30  or 95:\
+                            use METRIC=RANGE (repeatable) to set RANGE for a single metric')
+    parser.add_argument('-c', '--critical', metavar='RANGE', action='append',
                         help='return critical if metric is outside RANGE,\
-                            RANGE is defined as an number or an interval, e.g. 5:25 or :30  or 95:')
+                            RANGE is defined as an number or an interval, e.g. 5:25 or :30  or 95:\
+                            use METRIC=RANGE (repeatable) to set RANGE for a single metric')
     parser.add_argument('--max', action='store', default=None,
                         help='maximum value for performance data')
     parser.add_argument('--min', action='store', default=None,
                         help='minimum value for performance data')
     parser.add_argument('-t', '--tmpdir', action='store', default='/tmp/check_javamelody_health',
-                        help='path to directory to store delta files')
-    parser.add_argument('-u', '--url', action='store',
-                        help='url for javamelody instance, e.g. http://internal.example.com/sampleapp/javamelody')
+                        help='path to directory to store previous values (state.sqlite) and cached responses')
+    parser.add_argument('--rate-window', action='store', type=int, default=0, metavar='SECONDS',
+                        help='calculate *_timed metrics over the last SECONDS instead of since the previous execution')
+    parser.add_argument('--state-samples', action='store', type=int, default=100, metavar='N',
+                        help='amount of previous values kept per metric, should cover --rate-window')
+    parser.add_argument('--cache-max-age', action='store', type=int, default=0, metavar='SECONDS',
+                        help='share responses from javamelody between executions through a cache in --tmpdir,\
+                            responses older than SECONDS are grabbed again. Disabled by default (0)')
+    parser.add_argument('--index-max-age', action='store', type=int, default=0, metavar='SECONDS',
+                        help='keep an index of all requests recorded by javamelody in --tmpdir and look up\
+                            per-path metrics in it for SECONDS, without grabbing from javamelody at all')
+    parser.add_argument('--time-budget', action='store', type=float, default=None, metavar='SECONDS',
+                        help='stop grabbing from javamelody once SECONDS have passed, e.g. slightly below the\
+                            check timeout of icinga, and fall back to stale data (see --stale-max-age)')
+    parser.add_argument('--stale-max-age', action='store', type=int, default=0, metavar='SECONDS',
+                        help='keep responses in --tmpdir and use them if javamelody fails to respond in time,\
+                            as long as they are younger than SECONDS. Output is marked as STALE then')
+    parser.add_argument('--breaker-threshold', action='store', type=int, default=0, metavar='N',
+                        help='stop grabbing from javamelody for --breaker-backoff seconds after N consecutive failures')
+    parser.add_argument('--breaker-backoff', action='store', type=int, default=30, metavar='SECONDS',
+                        help='seconds to wait after --breaker-threshold failures, doubled with every further failure')
+    parser.add_argument('--collector-socket', action='store', default=None, metavar='PATH',
+                        help='ask the collector listening on unix socket PATH for responses,\
+                            falls back to grabbing directly from javamelody if the collector is unavailable')
+    parser.add_argument('--collector-interval', action='store', type=int, default=10, metavar='SECONDS',
+                        help='interval in which the collector grabs fresh responses from javamelody')
+    parser.add_argument('--scrape-interval', action='store', type=int, default=15, metavar='SECONDS',
+                        help='with --serve, grab from javamelody at most once every SECONDS')
+    parser.add_argument('-u', '--url', action='append', default=None,
+                        help='url for javamelody instance, e.g. http://internal.example.com/sampleapp/javamelody ,\
+                            repeat to check several instances concurrently')
+    parser.add_argument('--url-file', action='store', default=None, metavar='FILE',
+                        help='like --url, one url per line')
+    parser.add_argument('--cluster', action='store_true', default=False,
+                        help='treat the given urls as nodes of one application, per-path metrics are evaluated\
+                            over the summed up stats of all nodes and the worst node is reported as well')
+    parser.add_argument('--concurrency', action='store', type=int, default=10,
+                        help='maximum amount of instances checked at the same time when checking several urls')
+    parser.add_argument('--deadline', action='store', type=float, default=None, metavar='SECONDS',
+                        help='instances which did not respond within SECONDS count as unreachable_targets\
+                            when checking several urls (default: warning if any instance is unreachable)')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='increase output verbosity (use up to 3 times)')
+    parser.add_argument('--self-perfdata', action='store_true', default=False,
+                        help='add wall time, bytes transferred and peak memory of each phase of the plugin\
+                            itself to the performance data (self_*), shown in -vvv output as well')
     parser.add_argument('-p', '--request-path', action='store', default=None,
                         help='path to request, e.g. /users/list or /index.html ,\
                          see --scan option to list available paths')
-    parser.add_argument('-e', '--endpoint-type', action='store', default="http",
-                        help='type of request wanted, e.g. http, sql, jpa . Use --scan for listing.')
+    parser.add_argument('--batch-request', action='append', default=None, metavar='[ENDPOINT_TYPE:]PATH METHOD',
+                        help='evaluate the per-path metrics for every given request (repeatable) in a single run,\
+                         e.g. "/api/list_users GET" or "sql:SELECT ..." . ENDPOINT_TYPE defaults to --endpoint-type')
+    parser.add_argument('--batch-file', action='store', default=None, metavar='FILE',
+                        help='like --batch-request, one request per line')
+    parser.add_argument('--top-n', action='store', type=int, default=5, metavar='N',
+                        help='amount of requests or classes reported by the top_requests_* and top_classes_* metrics')
+    parser.add_argument('--class-name', action='store', default=None,
+                        help='class to evaluate class_bytes_growth_timed for, e.g. java.lang.String or [B')
+    parser.add_argument('--min-hits', action='store', type=int, default=1, metavar='N',
+                        help='ignore requests with less than N hits for the top_requests_* metrics, --scan and --serve')
+    parser.add_argument('-e', '--endpoint-type', action='store', default=None,
+                        help='type of request wanted, e.g. http, sql, jpa (default: http, all types for --scan).\
+                            Use --scan for listing.')
+    parser.add_argument('--path-regex', action='store', default=None, metavar='REGEX',
+                        help='only list (--scan) or export (--serve) requests matching REGEX, e.g. "^/api/.* GET$"')
     parser.add_argument('-m', '--request-method', action='store', default="GET",
                         help='e.g. http verbs: GET, POST, PUT ...')
     execution_mode = parser.add_mutually_exclusive_group(required=True)
-    execution_mode.add_argument('--metric', action='store', required=False, help='Supported keywords: {}'.format(
-        ", ".join(CheckJavamelodyHealthContext.fmt_helper.keys())))
-    execution_mode.add_argument('--scan', action='store_true', default=False, help='Show available endpoints')
+    execution_mode.add_argument('--metric', action='extend', nargs='+', required=False,
+                                help='one or more metrics, evaluated from a single grab per javamelody part.\
+                                Supported keywords: {}'.format(", ".join(CheckJavamelodyHealthContext.fmt_helper.keys())))
+    execution_mode.add_argument('--all-jvm-metrics', action='store_true', default=False,
+                                help='evaluate all metrics based on the jvm part: {}'.format(
+                                    ", ".join(CheckJavamelodyHealth.jvm_metrics)))
+    execution_mode.add_argument('--scan', action='store_true', default=False,
+                                help='Show available endpoints, one json object per request (JSON Lines)')
+    execution_mode.add_argument('--collector', action='store_true', default=False,
+                                help='run as collector on --collector-socket (default: collector.sock in --tmpdir)')
+    execution_mode.add_argument('--serve', action='store', default=None, metavar='[ADDRESS:]PORT',
+                                help='serve the metrics of every --url for prometheus on http://ADDRESS:PORT/metrics')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.top_n < 1:
+        parser.error("argument --top-n: must be at least 1")
+    return args
 
 
 @nag.guarded
 def main():
+    startup_seconds = process_time()
     args = parse_arguments()
-    check = nag.Check(
-        CheckJavamelodyHealth(
-            args.metric,
-            tmpdir=args.tmpdir,
-            url=args.url,
-            min=args.min,
-            max=args.max,
-            scan=args.scan,
-            request_path=args.request_path,
-            request_method=args.request_method,
-            endpoint_type=args.endpoint_type),
-        CheckJavamelodyHealthContext(args.metric, warning=args.warning, critical=args.critical),
-        CheckJavamelodyHealthSummary(args.url))
+    if args.collector:
+        if not isdir(args.tmpdir):
+            makedirs(args.tmpdir, exist_ok=True)
+        CheckJavamelodyHealthCollector(args.collector_socket or join(args.tmpdir, "collector.sock"),
+                                       interval=args.collector_interval).serve_forever()
+        return
+    metrics = list(OrderedDict.fromkeys(CheckJavamelodyHealth.jvm_metrics if args.all_jvm_metrics else args.metric or []))
+    instrumentation = None
+    if args.self_perfdata or args.verbose >= 3:
+        instrumentation = CheckJavamelodyHealthInstrumentation(startup_seconds, perfdata=args.self_perfdata)
+    urls = (args.url or []) + (get_lines_from_file(args.url_file) if args.url_file else [])
+    create_target = partial(
+        CheckJavamelodyHealth,
+        tmpdir=args.tmpdir,
+        url_timeout=min(10, args.deadline) if args.deadline else 10,
+        min=args.min,
+        max=args.max,
+        scan=args.scan,
+        request_path=args.request_path,
+        request_method=args.request_method,
+        endpoint_type=args.endpoint_type,
+        cache_max_age=args.cache_max_age,
+        collector_socket=args.collector_socket,
+        batch_requests=get_batch_requests(args.batch_request, args.batch_file,
+                                          args.endpoint_type or CheckJavamelodyHealth.default_endpoint_type),
+        rate_window=args.rate_window,
+        state_samples=args.state_samples,
+        top_n=args.top_n,
+        min_hits=args.min_hits,
+        time_budget=args.time_budget,
+        stale_max_age=args.stale_max_age,
+        breaker_threshold=args.breaker_threshold,
+        breaker_backoff=args.breaker_backoff,
+        connection_pool=JavamelodyConnectionPool(),
+        instrumentation=instrumentation,
+        path_regex=args.path_regex,
+        class_name=args.class_name,
+        index_max_age=args.index_max_age)
+    if args.serve:
+        CheckJavamelodyHealthExporter(urls, create_target, args.serve, interval=args.scrape_interval,
+                                      min_hits=args.min_hits).serve_forever()
+        return
+    targets = [create_target(metrics, url=url) for url in urls or [None]]
+    if len(targets) > 1:
+        if args.cluster:
+            resource = CheckJavamelodyHealthCluster(targets, concurrency=args.concurrency, deadline=args.deadline)
+            summary = CheckJavamelodyHealthSummary("cluster of {} nodes".format(len(targets)))
+        else:
+            resource = CheckJavamelodyHealthTargets(targets, concurrency=args.concurrency, deadline=args.deadline)
+            summary = CheckJavamelodyHealthSummary("{} targets".format(len(targets)))
+        check = nag.Check(resource, summary)
+        #unreachable targets result in a warning unless set otherwise with -w/-c unreachable_targets=RANGE
+        warning_defaults, critical_defaults = {"unreachable_targets": "0"}, {"unreachable_targets": ""}
+        if args.cluster:
+            #the worst node only affects the state if set with -w/-c METRIC_worst_node=RANGE
+            worst_node_defaults = {metric + CheckJavamelodyHealthCluster.worst_node_suffix: ""
+                                   for metric in metrics if metric in CheckJavamelodyHealth.path_metrics}
+            warning_defaults.update(worst_node_defaults)
+            critical_defaults.update(worst_node_defaults)
+    else:
+        check = nag.Check(targets[0], CheckJavamelodyHealthSummary(targets[0].url))
+        warning_defaults = critical_defaults = {}
+    warning_per_metric = get_thresholds_per_metric(args.warning, metrics, warning_defaults)
+    critical_per_metric = get_thresholds_per_metric(args.critical, metrics, critical_defaults)
+    for metric in warning_per_metric:
+        check.add(CheckJavamelodyHealthContext(metric,
+                                               warning=warning_per_metric[metric],
+                                               critical=critical_per_metric[metric]))
+    #added last, so the phases of the other resources are complete once it's probed
+    if instrumentation:
+        check.add(instrumentation)
+        if args.self_perfdata:
+            check.add(nag.ScalarContext(instrumentation.context))
     check.main(verbose=args.verbose)
 
 